@@ -5,11 +5,25 @@ functions on the data received
 
 import numpy as np
 import logging
+import math
+import metrics
+
+# the tracked tone is taken to have moved once the magnitude of its cross
+# spectrum or its coherence fall below these fractions of their values when
+# it was found
+TRACKING_MAGNITUDE_DROP = 0.25
+TRACKING_COHERENCE_DROP = 0.5
 
 class AdcDataWrapper:
-    def __init__(self, correlator, zdok_n, fs = 800e6, logger=logging.getLogger(__name__)):
+    def __init__(self, correlator, zdok_n, fs = 800e6, track_tone=False, recorder=None,
+                 logger=logging.getLogger(__name__)):
         """
         correlator -- instance of directionFinder_backend.correlator.Correlator
+        track_tone -- if True, once the strongest tone has been found only its
+            bin and the bins either side are evaluated for the phase
+            statistics. A full FFT is only done again if the tone moves or
+            fades. See TRACKING_MAGNITUDE_DROP and TRACKING_COHERENCE_DROP
+        recorder -- CaptureRecorder to which every capture is appended. Default: None
         mode -- 'I', 'Q', or 'inter'.
             I: only get the snap from I channel
             Q: only get the snap from Q channel
@@ -20,52 +34,480 @@ class AdcDataWrapper:
         self.correlator = correlator
         self.zdok_n = zdok_n
         self.fs = float(fs)
+        self.generation = 0  # incremented with every capture
+        self._statistics = {}  # (name, args) -> value for the current generation
+        self._resample_timer = metrics.REGISTRY.timer(
+            'adw_resample_seconds', "Time taken to fetch each snapshot", zdok=zdok_n)
+        self._cache_hits = metrics.REGISTRY.counter(
+            'adw_statistic_cache_hits_total', "Statistics served from the per-capture cache", zdok=zdok_n)
+        self._analysis_timers = {}  # statistic name -> Timer
+        self.track_tone = track_tone
+        self.recorder = recorder
+        self._tracked_bin = None  # bin of the tone found by the last full FFT
+        self._tracked_magnitude = None  # its magnitude and coherence in that FFT
+        self._tracked_coherence = None
+        self._projections = {}  # (segment_length, bins) -> DFT matrix
+        self._tracking_fallbacks = metrics.REGISTRY.counter(
+            'adw_tone_tracking_fallbacks_total', "Full FFTs done because the tracked tone moved", zdok=zdok_n)
 
     def resample(self):
         """ Updates the samples from the ADC
         """
-        self.correlator.fetch_time_domain_snapshot(force=True)
+        with self._resample_timer.time():
+            self.correlator.fetch_time_domain_snapshot(force=True)
+        self.generation += 1
+        self._statistics = {}
+        if self.recorder is not None:
+            self.recorder.record(self.zdok_n, self._signal('I'), self._signal('Q'))
+
+    def _statistic(self, key, compute):
+        """ Returns the value of a statistic of the current capture, only calling
+        compute the first time it is asked for after each resample.
+        """
+        if key in self._statistics:
+            self._cache_hits.inc()
+            return self._statistics[key]
+        name = key[0] if isinstance(key, tuple) else key
+        if name not in self._analysis_timers:
+            self._analysis_timers[name] = metrics.REGISTRY.timer(
+                'adw_analysis_seconds', "Time taken to compute each statistic of a capture",
+                zdok=self.zdok_n, statistic=name)
+        with self._analysis_timers[name].time():
+            self._statistics[key] = compute()
+        return self._statistics[key]
+
+    def _signal(self, channel):
+        chan_idx = ['I', 'Q'].index(channel) + (2*self.zdok_n)
+        return self.correlator.time_domain_signals[chan_idx]
 
     def get_offset(self, channel):
         """ Returns the DC offset of a channel.
         Channel is ('I', 'Q')
         """
-        chan_idx = ['I', 'Q'].index(channel) + (2*self.zdok_n)
-        mean = np.mean(self.correlator.time_domain_signals[chan_idx])
+        mean = self._statistic(('offset', channel), lambda: np.mean(self._signal(channel)))
         self.logger.debug("Offset for channel {c}: {v}".format(c = channel, v = mean))
         return mean
 
+    def get_variance(self, channel):
+        return self._statistic(('variance', channel), lambda: np.var(self._signal(channel)))
+
+    def get_offset_error(self, channel, segment_length=2**11):
+        """ Returns the standard error of #get_offset, from the spread of the
+        means of segments of segment_length. A tone mostly averages out
+        within each segment so, unlike the spread of the samples, this
+        isn't inflated by the tone. Falls back to the spread of the samples
+        if there are fewer than two segments.
+        """
+        def compute():
+            signal = self._signal(channel)
+            num_segments = len(signal) // segment_length
+            if num_segments < 2:
+                return np.std(signal) / np.sqrt(len(signal))
+            means = np.mean(self._segment(['I', 'Q'].index(channel) + (2 * self.zdok_n), segment_length), axis=1)
+            return np.std(means, ddof=1) / np.sqrt(num_segments)
+        return self._statistic(('offset_error', channel, segment_length), compute)
+
     def get_power(self, channel):
-        chan_idx = ['I', 'Q'].index(channel) + (2*self.zdok_n)
-        signal = self.correlator.time_domain_signals[chan_idx]
-        energy = np.sum(np.square(signal))
-        power = energy / len(signal)
+        def compute():
+            signal = self._signal(channel)
+            energy = np.sum(np.square(signal, dtype=np.float64))  # int8 samples would overflow
+            return energy / len(signal)
+        power = self._statistic(('power', channel), compute)
         self.logger.debug("Power for channel {c}: {v}".format(c = channel, v = power))
         return power
 
+    def get_power_error(self, channel):
+        """ Returns the standard error of #get_power
+        """
+        def compute():
+            signal = self._signal(channel)
+            return np.std(np.square(signal, dtype=np.float64)) / np.sqrt(len(signal))
+        return self._statistic(('power_error', channel), compute)
+
+    def get_power_ratio(self):
+        """ Returns the power of I relative to Q in dB
+        """
+        return 10 * np.log10(self.get_power('I') / self.get_power('Q'))
+
+    def get_power_ratio_error(self):
+        """ Returns the standard error of #get_power_ratio in dB
+        """
+        relative = [self.get_power_error(c) / self.get_power(c) for c in ('I', 'Q')]
+        return (10 / np.log(10)) * np.sqrt(relative[0]**2 + relative[1]**2)
+
+    def get_core_gain_mismatch(self):
+        """ Returns how much larger the AC power of I is than Q in dB. When
+        interleaving, both cores see the same input so this is the gain
+        mismatch between them, unaffected by their offsets.
+        """
+        return 10 * np.log10(self.get_variance('I') / self.get_variance('Q'))
+
+    def get_core_gain_mismatch_error(self):
+        """ Returns the standard error of #get_core_gain_mismatch in dB
+        """
+        def compute(channel):
+            signal = self._signal(channel)
+            deviations = np.square(signal - self.get_offset(channel))
+            return np.std(deviations) / (np.sqrt(len(signal)) * self.get_variance(channel))
+        relative = [self._statistic(('variance_error', c), lambda: compute(c)) for c in ('I', 'Q')]
+        return (10 / np.log(10)) * np.sqrt(relative[0]**2 + relative[1]**2)
+
+    def get_extremes(self, channel):
+        """ Returns a tuple of the (minimum, maximum) sample of a channel.
+        Useful for spotting clipping.
+        """
+        def compute():
+            signal = self._signal(channel)
+            return (np.min(signal), np.max(signal))
+        return self._statistic(('extremes', channel), compute)
+
+    def get_cross_spectrum(self, segment_length=2**11):
+        """ Returns the averaged spectra between I and Q as a dict with keys:
+            freqs -- frequency of each bin in Hz
+            cross -- cross spectrum, fft(I) * conj(fft(Q))
+            auto_I, auto_Q -- power spectrum of each channel
+            coherence -- magnitude squared coherence between I and Q
+            segments -- number of segments averaged
+        Each channel is cut into segments of segment_length which are
+        transformed together and averaged.
+        """
+        return self._statistic(('cross_spectrum', segment_length),
+                               lambda: self._compute_cross_spectrum(segment_length))
+
+    def _compute_cross_spectrum(self, segment_length):
+        segments = [self._segment(chan_idx, segment_length) 
+                    for chan_idx in (0 + (2 * self.zdok_n), 1 + (2 * self.zdok_n))]
+        fft_a, fft_b = [np.fft.rfft(segment, axis=1) for segment in segments]
+        num_segments = fft_a.shape[0]
+        cross = np.einsum('ij,ij->j', fft_a, np.conj(fft_b)) / num_segments
+        auto_a = np.einsum('ij,ij->j', fft_a, np.conj(fft_a)).real / num_segments
+        auto_b = np.einsum('ij,ij->j', fft_b, np.conj(fft_b)).real / num_segments
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coherence = np.nan_to_num(np.abs(cross)**2 / (auto_a * auto_b))
+        return {
+            'freqs': np.fft.rfftfreq(segment_length, 1.0/self.fs),
+            'cross': cross,
+            'auto_I': auto_a,
+            'auto_Q': auto_b,
+            'coherence': coherence,
+            'segments': num_segments,
+        }
+
+    def _segment(self, chan_idx, segment_length):
+        """ Returns a view of the channel as a 2D array with one segment per row.
+        Samples which don't fill a whole segment are dropped.
+        """
+        signal = np.asarray(self.correlator.time_domain_signals[chan_idx])
+        num_segments = len(signal) // segment_length
+        return signal[:num_segments * segment_length].reshape(num_segments, segment_length)
+
+    def _tone_spectra(self):
+        """ Returns a tuple of (spectra, index of the tone in them), where spectra
+        is in the form of #get_cross_spectrum. When tracking the tone these are
+        only the bins around it.
+        """
+        if self.track_tone:
+            tracked = self._statistic('tracked_spectrum', self._compute_tracked_spectrum)
+            if tracked is not None:
+                return tracked
+        return (self.get_cross_spectrum(), self._tone_bin())
+
+    def _compute_tracked_spectrum(self, segment_length=2**11):
+        """ Projects every segment onto the DFT bins either side of and at the
+        tracked tone, which takes O(N) rather than the O(N log N) of a full FFT.
+        Returns None if no tone has been found yet or the tone has moved, in
+        which case the next full FFT finds it again. The tone has moved if a
+        neighbouring bin is stronger, or if the tracked bin has faded well
+        below its magnitude or coherence when it was found. Once a tone has
+        moved far away the three bins hold only noise, so which is strongest
+        says little.
+        """
+        if self._tracked_bin is None:
+            return None
+        bins = tuple(b for b in range(self._tracked_bin - 1, self._tracked_bin + 2)
+                     if 0 <= b <= segment_length // 2)
+        key = (segment_length, bins)
+        if key not in self._projections:
+            self._projections[key] = np.exp(
+                -2j * np.pi * np.outer(np.arange(segment_length), bins) / segment_length)
+        projection = self._projections[key]
+        dft_a, dft_b = [np.dot(self._segment(chan_idx, segment_length), projection)
+                        for chan_idx in (0 + (2 * self.zdok_n), 1 + (2 * self.zdok_n))]
+        num_segments = dft_a.shape[0]
+        cross = np.einsum('ij,ij->j', dft_a, np.conj(dft_b)) / num_segments
+        tone_idx = bins.index(self._tracked_bin)
+        auto_a = np.einsum('ij,ij->j', dft_a, np.conj(dft_a)).real / num_segments
+        auto_b = np.einsum('ij,ij->j', dft_b, np.conj(dft_b)).real / num_segments
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coherence = np.nan_to_num(np.abs(cross)**2 / (auto_a * auto_b))
+        if (np.argmax(np.abs(cross)) != tone_idx) or \
+                (np.abs(cross[tone_idx]) < TRACKING_MAGNITUDE_DROP * self._tracked_magnitude) or \
+                (coherence[tone_idx] < TRACKING_COHERENCE_DROP * self._tracked_coherence):
+            self.logger.debug("Tone moved away from bin {b}. Doing a full FFT".format(b = self._tracked_bin))
+            self._tracking_fallbacks.inc()
+            self._tracked_bin = None
+            return None
+        spectra = {
+            'freqs': np.array(bins) * (self.fs / segment_length),
+            'cross': cross,
+            'auto_I': auto_a,
+            'auto_Q': auto_b,
+            'coherence': coherence,
+            'segments': num_segments,
+        }
+        return (spectra, tone_idx)
+
     def get_phase_difference(self):
         """ Retuns phase difference between strongest signal
         Does phase(I) - phase(Q)
         If the phase is positive, it means that I comes before Q. I leads. 
         If the phase is negative, it means Q comes before I. 
         """
-        chan_a_idx = 0 + (2 * self.zdok_n)  
-        chan_b_idx = 1 + (2 * self.zdok_n)
-        chan_a_sub_arrays = np.split(
-            self.correlator.time_domain_signals[chan_a_idx], 
-            len(self.correlator.time_domain_signals[chan_a_idx])/2**11)
-        chan_b_sub_arrays = np.split(
-            self.correlator.time_domain_signals[chan_b_idx],
-            len(self.correlator.time_domain_signals[chan_b_idx])/2**11)
-        cross_acc = np.ndarray((2**11/2) + 1, dtype=np.complex128)
-        for sub_idx in range(len(chan_a_sub_arrays)):
-            fft_a = np.fft.rfft(chan_a_sub_arrays[sub_idx])
-            fft_b = np.fft.rfft(chan_b_sub_arrays[sub_idx])
-            cross = fft_a * np.conj(fft_b)
-            cross_acc += cross
-        max_idx = np.argmax(np.abs(cross_acc))
-        max_freq = self.fs/2 * (max_idx / float(len(cross_acc)))
-        max_phase = np.angle(cross_acc[max_idx])
+        spectra, max_idx = self._tone_spectra()
+        max_freq = spectra['freqs'][max_idx]
+        max_phase = np.angle(spectra['cross'][max_idx])
         self.logger.debug("Between I and Q, max freq: {f} with phase difference: {ph}".format(
             f = max_freq/1e6, ph = max_phase))
         return max_phase
+
+    def get_tone_frequency(self):
+        """ Returns the frequency in Hz of the strongest signal, as seen in the
+        first Nyquist zone.
+        """
+        spectra, tone_idx = self._tone_spectra()
+        return spectra['freqs'][tone_idx]
+
+    def get_interleaved(self):
+        """ Returns the samples of the I and Q cores interleaved into a single
+        signal at twice the sample rate. The Q core is assumed to sample half
+        a period after the I core, ie: clock selection 'neg'.
+        """
+        def compute():
+            sig_i, sig_q = self._signal('I'), self._signal('Q')
+            length = min(len(sig_i), len(sig_q))
+            interleaved = np.empty(2 * length, dtype=np.float64)
+            interleaved[0::2] = sig_i[:length]
+            interleaved[1::2] = sig_q[:length]
+            return interleaved
+        return self._statistic('interleaved', compute)
+
+    def get_interleave_mismatch(self, guard_bins=8):
+        """ Estimates the mismatch between the cores from a single FFT of the
+        interleaved signal. Returns a dict with:
+            offset_I, offset_Q -- offset of each core in LSB
+            gain_mismatch -- how much higher the gain of the I core is than
+                the Q core in dB
+            timing_mismatch -- how late the Q core samples compared to half
+                way between the I samples in seconds
+            tone_freq -- frequency of the strongest signal in Hz
+        The offset mismatch makes a spur at fs/2 and the gain and timing
+        mismatches make an image of the tone at fs/2 - f_in, where fs is
+        the interleaved rate. Relative to the tone, the real part of the
+        image is due to the gain mismatch and the imaginary part is due to
+        the timing mismatch.
+        guard_bins -- bins next to DC and fs/2 which can't hold the tone
+        """
+        def compute():
+            signal = self.get_interleaved()
+            window = np.blackman(len(signal))
+            spectrum = np.fft.rfft(signal * window)
+            coherent_gain = np.sum(window)
+            mean = spectrum[0].real / coherent_gain
+            half_difference = spectrum[-1].real / coherent_gain  # (offset_I - offset_Q) / 2
+            tone_bin = guard_bins + np.argmax(np.abs(spectrum[guard_bins:-guard_bins]))
+            image_bin = (len(spectrum) - 1) - tone_bin
+            tone_freq = tone_bin * (2 * self.fs) / len(signal)
+            if abs(image_bin - tone_bin) < guard_bins:
+                self.logger.warn("Tone at {f} MHz is too close to fs/4 to separate it from its image".format(
+                    f = tone_freq / 1e6))
+            # (gain_I - gain_Q) + j*2*pi*f_in*(delay_Q) relative to the mean gain
+            mismatch = 2 * spectrum[image_bin] / np.conj(spectrum[tone_bin])
+            return {
+                'offset_I': mean + half_difference,
+                'offset_Q': mean - half_difference,
+                'gain_mismatch': 20 * np.log10((1 + mismatch.real / 2) / (1 - mismatch.real / 2)),
+                'timing_mismatch': mismatch.imag / (2 * np.pi * tone_freq),
+                'tone_freq': tone_freq,
+            }
+        return self._statistic(('interleave_mismatch', guard_bins), compute)
+
+    def get_phase_error(self):
+        """ Returns the standard deviation of #get_phase_difference in radians
+        as estimated from the coherence at the strongest signal.
+        """
+        spectra, tone_idx = self._tone_spectra()
+        coherence = spectra['coherence'][tone_idx]
+        if coherence <= 0:
+            return np.pi
+        return np.sqrt((1 - coherence) / (2 * spectra['segments'] * coherence))
+
+    def _tone_bin(self):
+        """ Returns the index of the strongest bin of the cross spectrum
+        """
+        def compute():
+            spectra = self.get_cross_spectrum()
+            tone_bin = np.argmax(np.abs(spectra['cross']))
+            self._tracked_bin = tone_bin
+            self._tracked_magnitude = np.abs(spectra['cross'][tone_bin])
+            self._tracked_coherence = spectra['coherence'][tone_bin]
+            return tone_bin
+        return self._statistic('tone_bin', compute)
+
+    def stream(self, done, max_captures=8, with_spectra=False):
+        """ Merges the current capture and as many new captures as needed into
+        a StreamingStatistics.
+
+        done -- callable taking the StreamingStatistics. Returns True once
+            enough captures have been merged.
+        max_captures -- maximum number of captures to merge, including the current one
+        with_spectra -- if True, the cross spectrum is accumulated too
+        Returns the StreamingStatistics
+        """
+        stats = StreamingStatistics(with_spectra)
+        stats.add(self)
+        while (not done(stats)) and (stats.captures < max_captures):
+            self.resample()
+            stats.add(self)
+        self.logger.debug("Merged {n} captures".format(n = stats.captures))
+        return stats
+
+    def get_offset_streaming(self, channels, confidence=0.95, max_captures=8):
+        """ Returns a dict mapping each of channels to its offset, averaged over
+        only as many captures as it takes to know the sign of every offset
+        with the given confidence. Starts with the current capture.
+        """
+        z = z_score(confidence)
+        stats = self.stream(lambda st: all(
+            abs(st.get_offset(c)) >= z * st.get_offset_error(c) for c in channels), max_captures)
+        return dict((c, stats.get_offset(c)) for c in channels)
+
+    def get_phase_difference_streaming(self, confidence=0.95, max_captures=8):
+        """ As #get_phase_difference, but averaged over only as many captures
+        as it takes to know the sign of the phase with the given confidence.
+        Starts with the current capture.
+        """
+        z = z_score(confidence)
+        stats = self.stream(lambda st: abs(st.get_phase_difference()) >= z * st.get_phase_error(),
+                            max_captures, with_spectra=True)
+        return stats.get_phase_difference()
+
+class StreamingStatistics(object):
+    def __init__(self, with_spectra=False):
+        """ Running mean, variance and cross spectrum over several captures.
+        Captures are merged with the parallel form of Welford's algorithm so
+        the samples never need to be kept.
+
+        with_spectra -- if True, the cross spectrum is accumulated too
+        """
+        self.with_spectra = with_spectra
+        self.captures = 0
+        self._counts = {}  # channel -> number of samples
+        self._offset_variances = {}  # channel -> sum over captures of (samples * offset error)**2
+        self._means = {}
+        self._m2s = {}  # channel -> sum of squared deviations from the mean
+        self._segments = 0
+        self._spectra = None  # sums over all segments of cross, auto_I and auto_Q
+        self._freqs = None
+
+    def add(self, adc_data_wrapper):
+        """ Merges the current capture of adc_data_wrapper
+        """
+        for channel in ('I', 'Q'):
+            count_b = len(adc_data_wrapper._signal(channel))
+            mean_b = adc_data_wrapper.get_offset(channel)
+            m2_b = adc_data_wrapper.get_variance(channel) * count_b
+            count_a = self._counts.get(channel, 0)
+            mean_a = self._means.get(channel, 0.0)
+            count = count_a + count_b
+            delta = mean_b - mean_a
+            self._means[channel] = mean_a + (delta * count_b / float(count))
+            self._m2s[channel] = self._m2s.get(channel, 0.0) + m2_b + (delta**2 * count_a * count_b / float(count))
+            self._counts[channel] = count
+            self._offset_variances[channel] = self._offset_variances.get(channel, 0.0) + \
+                (count_b * adc_data_wrapper.get_offset_error(channel))**2
+        if self.with_spectra:
+            self._add_spectra(adc_data_wrapper)
+        self.captures += 1
+
+    def _add_spectra(self, adc_data_wrapper):
+        spectra = adc_data_wrapper.get_cross_spectrum()
+        sums = [spectra[key] * spectra['segments'] for key in ('cross', 'auto_I', 'auto_Q')]
+        if self._spectra is None:
+            self._spectra = sums
+        else:
+            self._spectra = [acc + new for acc, new in zip(self._spectra, sums)]
+        self._segments += spectra['segments']
+        self._freqs = spectra['freqs']
+
+    def get_offset(self, channel):
+        return self._means[channel]
+
+    def get_variance(self, channel):
+        return self._m2s[channel] / self._counts[channel]
+
+    def get_offset_error(self, channel):
+        """ Returns the standard error of #get_offset, combining the
+        AdcDataWrapper#get_offset_error of each capture
+        """
+        return np.sqrt(self._offset_variances[channel]) / self._counts[channel]
+
+    def get_power_ratio(self):
+        """ Returns the AC power of I relative to Q in dB
+        """
+        return 10 * np.log10(self.get_variance('I') / self.get_variance('Q'))
+
+    def get_power_ratio_error(self):
+        """ Returns the standard error of #get_power_ratio in dB, assuming the
+        samples are independent and Gaussian
+        """
+        relative = [np.sqrt(2.0 / self._counts[c]) for c in ('I', 'Q')]
+        return (10 / np.log(10)) * np.sqrt(relative[0]**2 + relative[1]**2)
+
+    def get_cross_spectrum(self):
+        """ Returns the spectra averaged over all segments of all captures in
+        the same form as AdcDataWrapper#get_cross_spectrum
+        """
+        cross, auto_a, auto_b = [acc / self._segments for acc in self._spectra]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coherence = np.nan_to_num(np.abs(cross)**2 / (auto_a * auto_b))
+        return {
+            'freqs': self._freqs,
+            'cross': cross,
+            'auto_I': auto_a,
+            'auto_Q': auto_b,
+            'coherence': coherence,
+            'segments': self._segments,
+        }
+
+    def get_phase_difference(self):
+        cross = self.get_cross_spectrum()['cross']
+        return np.angle(cross[np.argmax(np.abs(cross))])
+
+    def get_tone_frequency(self):
+        """ Returns the frequency in Hz of the strongest signal in the cross spectrum
+        """
+        return self._freqs[np.argmax(np.abs(self.get_cross_spectrum()['cross']))]
+
+    def get_phase_error(self):
+        """ Returns the standard deviation of #get_phase_difference in radians
+        """
+        spectra = self.get_cross_spectrum()
+        coherence = spectra['coherence'][np.argmax(np.abs(spectra['cross']))]
+        if coherence <= 0:
+            return np.pi
+        return np.sqrt((1 - coherence) / (2 * spectra['segments'] * coherence))
+
+def z_score(confidence):
+    """ Returns z such that a normally distributed variable is below z
+    standard deviations with probability confidence. Found by bisection so
+    as not to depend on scipy.
+    """
+    assert(0.5 <= confidence < 1)
+    low, high = 0.0, 10.0
+    for _ in range(60):
+        mid = (low + high) / 2
+        if 0.5 * (1 + math.erf(mid / math.sqrt(2))) < confidence:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
@@ -22,3 +22,5 @@ if __name__ == '__main__':
         iadc.registers.get_from_file('registers_{zdok_n}.json'.format(zdok_n = zdok_n))
         iadc.set_cal_mode('no_cal')
         iadc.write_all_registers()
+        logger.info("ZDOK {z}: {i} SPI writes issued, {s} skipped as unchanged".format(
+            z = zdok_n, i = iadc.spi_writes_issued, s = iadc.spi_writes_skipped))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Benchmarks the calibration routines against the simulated ADC.
+
+Each routine is run from many seeded starting states and capture sizes.
+For each run the wall time, SPI writes, snapshots, time spent sleeping and
+final residual error are written to a JSON file. Two such files can be
+compared to see whether a change made calibration faster or slower:
+
+    ./benchmark.py --output before.json
+    (change things)
+    ./benchmark.py --output after.json
+    ./benchmark.py --compare before.json after.json
+"""
+
+import argparse
+import json
+import logging
+import subprocess
+import time
+import numpy as np
+from iadc import IAdc
+from adc_data_wrapper import AdcDataWrapper
+from calibrator import Calibrator
+from settle_detector import SettleDetector
+from simulator import SimulatedCorrelator
+
+RESIDUAL_CAPTURES = 4  # captures averaged when measuring the residual error
+METRICS = ('wall_time', 'spi_writes', 'snapshots', 'sleep_time', 'residual')
+
+def offset_residual(stats):
+    """ Largest absolute offset of I and Q in LSB """
+    return max(abs(stats.get_offset('I')), abs(stats.get_offset('Q')))
+
+def phase_residual(stats):
+    """ Absolute phase difference in radians """
+    return abs(stats.get_phase_difference())
+
+def gain_residual(stats):
+    """ Absolute difference in AC power between I and Q in dB """
+    return abs(10 * np.log10(stats.get_variance('I') / stats.get_variance('Q')))
+
+# name -> (routine taking a Calibrator, residual taking a StreamingStatistics)
+ROUTINES = {
+    'offset_step': (lambda cal: cal.run_offset_cal(search='step'), offset_residual),
+    'offset_bisect': (lambda cal: cal.run_offset_cal(search='bisect'), offset_residual),
+    'offset_joint': (lambda cal: cal.run_offset_cal(search='joint'), offset_residual),
+    'offset_model': (lambda cal: cal.run_offset_cal_model(), offset_residual),
+    'phase': (lambda cal: cal.run_phase_difference_cal(), phase_residual),
+    'gain': (lambda cal: cal.run_analogue_gain_cal(), gain_residual),
+}
+
+def run_once(routine_name, seed, num_samples, settle_delay, logger):
+    """ Runs one routine on a freshly simulated ADC and returns a dict of results
+    """
+    routine, residual = ROUTINES[routine_name]
+    correlator = SimulatedCorrelator(num_zdoks=1, num_samples=num_samples, seed=seed)
+    iadc = IAdc(correlator.fpga, zdok_n = 0, mode = 'indep', logger = logger.getChild('iadc'))
+    adw = AdcDataWrapper(correlator, 0, fs = correlator.fs, logger = logger.getChild('adw'))
+    settle = SettleDetector(adw, mode='fixed', fixed_delay=settle_delay, logger=logger.getChild('settle'))
+    cal = Calibrator(iadc, adw, settle_detector=settle, logger=logger.getChild('calibrator'))
+    spi_writes = correlator.fpga.spi_writes
+    snapshots = correlator.snapshots
+    error = None
+    start = time.time()
+    try:
+        routine(cal)
+    except Exception as e:
+        error = '{t}: {e}'.format(t = type(e).__name__, e = e)
+    result = {
+        'routine': routine_name,
+        'seed': seed,
+        'num_samples': num_samples,
+        'wall_time': time.time() - start,
+        'spi_writes': correlator.fpga.spi_writes - spi_writes,
+        'snapshots': correlator.snapshots - snapshots,
+        'sleep_time': settle.time_slept,
+        'error': error,
+    }
+    adw.resample()
+    result['residual'] = float(residual(adw.stream(lambda stats: False, RESIDUAL_CAPTURES, with_spectra=True)))
+    return result
+
+def summarise(results):
+    """ Returns a dict mapping 'routine/num_samples' to the median of each
+    metric over all successful runs and the number of failed runs.
+    """
+    groups = {}
+    for result in results:
+        groups.setdefault('{r}/{n}'.format(r = result['routine'], n = result['num_samples']), []).append(result)
+    summary = {}
+    for key, group in groups.items():
+        ok = [r for r in group if r['error'] is None]
+        summary[key] = dict((m, float(np.median([r[m] for r in ok])) if ok else None) for m in METRICS)
+        summary[key]['failures'] = len(group) - len(ok)
+    return summary
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(before_filename, after_filename):
+    """ Prints the change in median of each metric between two result files
+    """
+    with open(before_filename) as f:
+        before = json.loads(f.read())['summary']
+    with open(after_filename) as f:
+        after = json.loads(f.read())['summary']
+    for key in sorted(set(before) & set(after)):
+        print(key)
+        for metric in METRICS + ('failures',):
+            old, new = before[key][metric], after[key][metric]
+            if (old is None) or (new is None):
+                print("    {m:<12} {o} -> {n}".format(m = metric, o = old, n = new))
+            else:
+                change = ((new - old) / float(old) * 100) if old else float('nan')
+                print("    {m:<12} {o:>12.4g} -> {n:>12.4g} ({c:+.1f}%)".format(m = metric, o = old, n = new, c = change))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the calibration routines against the simulated ADC")
+    parser.add_argument('--output', default='benchmark.json', help="file to write results to")
+    parser.add_argument('--routines', nargs='+', default=sorted(ROUTINES), choices=sorted(ROUTINES))
+    parser.add_argument('--seeds', type=int, default=10, help="number of seeded starting states")
+    parser.add_argument('--num-samples', type=int, nargs='+', default=[2**14, 2**16],
+                        help="samples per channel per snapshot")
+    parser.add_argument('--settle-delay', type=float, default=0.1, help="seconds slept after each register write")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    logger = logging.getLogger('benchmark')
+    logging.basicConfig(level=logging.WARNING)
+    if args.compare:
+        compare(*args.compare)
+    else:
+        results = []
+        for routine_name in args.routines:
+            for num_samples in args.num_samples:
+                for seed in range(args.seeds):
+                    results.append(run_once(routine_name, seed, num_samples, args.settle_delay, logger))
+        summary = summarise(results)
+        with open(args.output, 'w') as f:
+            f.write(json.dumps({'revision': revision(), 'summary': summary, 'results': results},
+                               sort_keys=True, indent=4))
+        for key in sorted(summary):
+            print("{k}: {s}".format(k = key, s = summary[key]))
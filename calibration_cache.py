@@ -0,0 +1,172 @@
+"""
+Remembers the last good registers of each ADC so that a restart doesn't
+have to calibrate from scratch.
+
+Entries are keyed by board, ZDOK and sample clock. Each holds the registers
+and the residual statistics measured straight after they were calibrated,
+the fitted offset slopes if any, and optionally the temperature at the
+time. On startup #warm_start writes the cached registers and takes one
+capture to decide whether to:
+    reuse -- the residuals match those cached to within the noise
+    refine -- they have drifted a little, so the routine is run starting
+        from the cached registers
+    full -- they have drifted a lot or there is no entry, so the routine
+        is run from the registers the ADC had before
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import numpy as np
+
+# residual -> largest drift from the cached value which a refinement can correct
+REFINE_LIMITS = {
+    'offset_I': 2.0,  # LSB
+    'offset_Q': 2.0,
+    'power_ratio': 0.2,  # dB
+    'phase': 0.1,  # radians
+}
+
+class CalibrationCache(object):
+    def __init__(self, filename='calibration_cache.json', temperature_tolerance=5.0,
+                 logger=logging.getLogger(__name__)):
+        """
+        filename -- JSON file in which the entries are persisted
+        temperature_tolerance -- entries calibrated at a temperature further
+            than this from the current one are ignored. Only applies if
+            both temperatures are known.
+        """
+        self.logger = logger
+        self.filename = filename
+        self.temperature_tolerance = temperature_tolerance
+        self._lock = threading.Lock()
+        self.entries = {}  # key -> dict with registers, residuals, offset_slopes, temperature and timestamp
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.loads(f.read())
+
+    @staticmethod
+    def key(board, zdok_n, clock):
+        """ Returns the key of the entry for a ZDOK of a board
+
+        board -- identifies the board. eg: the hostname of the ROACH
+        clock -- FPGA clock in MHz, as from FpgaClient#est_brd_clk
+        """
+        return '{b}/zdok{z}/{c:.0f}MHz'.format(b = board, z = zdok_n, c = clock)
+
+    def lookup(self, board, zdok_n, clock, temperature=None):
+        """ Returns the entry for a ZDOK of a board or None if there isn't a
+        usable one
+        """
+        with self._lock:
+            entry = self.entries.get(self.key(board, zdok_n, clock))
+        if entry is None:
+            return None
+        if (temperature is not None) and (entry['temperature'] is not None) and \
+                (abs(temperature - entry['temperature']) > self.temperature_tolerance):
+            self.logger.info("Cached registers for {k} are from {t} degrees. Ignoring them".format(
+                k = self.key(board, zdok_n, clock), t = entry['temperature']))
+            return None
+        return entry
+
+    def store(self, board, zdok_n, clock, registers, residuals, temperature=None, offset_slopes=None):
+        """ Records the registers of a ZDOK and the residuals they achieved
+        and persists all of the entries
+
+        registers -- dict as returned by IAdcRegisters#to_dict
+        residuals -- dict as returned by #measure_residuals
+        offset_slopes -- Calibrator#offset_slopes, if they have been fitted
+        """
+        with self._lock:
+            self.entries[self.key(board, zdok_n, clock)] = {
+                'registers': registers,
+                'residuals': residuals,
+                'offset_slopes': offset_slopes or {},
+                'temperature': temperature,
+                'timestamp': time.time(),
+            }
+            with open(self.filename, 'w') as f:
+                f.write(json.dumps(self.entries, sort_keys=True, indent=4))
+
+def measure_residuals(adw):
+    """ Returns a dict mapping the name of each residual statistic of the
+    current capture to a list of [value, standard error]
+    """
+    return {
+        'offset_I': [float(adw.get_offset('I')), float(adw.get_offset_error('I'))],
+        'offset_Q': [float(adw.get_offset('Q')), float(adw.get_offset_error('Q'))],
+        'power_ratio': [float(adw.get_power_ratio()), float(adw.get_power_ratio_error())],
+        'phase': [float(adw.get_phase_difference()), float(adw.get_phase_error())],
+    }
+
+def check_drift(residuals, cached, names=None, noise_multiple=3.0, refine_limits=REFINE_LIMITS):
+    """ Compares residuals measured now with those cached.
+    Returns 'reuse' if none have changed by more than noise_multiple standard
+    errors, 'refine' if none have changed by more than refine_limits, and
+    otherwise 'full'.
+
+    names -- which residuals to compare. Default: None, meaning all of those cached
+    """
+    decision = 'reuse'
+    for name in (names if names is not None else cached):
+        cached_value, cached_error = cached[name]
+        value, error = residuals[name]
+        drift = abs(value - cached_value)
+        if name == 'phase':
+            drift = abs(np.angle(np.exp(1j * (value - cached_value))))
+        if drift <= noise_multiple * np.hypot(error, cached_error):
+            continue
+        if drift > refine_limits.get(name, 0):
+            return 'full'
+        decision = 'refine'
+    return decision
+
+def warm_start(cal, cache, board, clock, routine, temperature=None, residuals=None):
+    """ Calibrates an ADC, starting from its cached registers if there are any.
+    Writes the cached registers and makes one capture to see if they are
+    still good (see #check_drift). Unless they are, runs routine, and then
+    caches the resulting registers, residuals and offset slopes. Cached
+    offset slopes are given to cal if it has none, so the fit in
+    Calibrator#run_offset_cal_model can be skipped.
+
+    cal -- Calibrator
+    cache -- CalibrationCache
+    routine -- callable taking cal which calibrates it.
+        eg: lambda cal: cal.run_offset_cal()
+    residuals -- names of the residuals which routine calibrates, eg:
+        ('offset_I', 'offset_Q'). Only these are checked, as the others
+        can change for reasons routine can't correct, such as a new tone.
+        Default: None, meaning all of them
+    Returns the decision: 'reuse', 'refine' or 'full'
+    """
+    entry = cache.lookup(board, cal.zdok_n, clock, temperature)
+    decision = 'full'
+    if (entry is not None) and (not cal.offset_slopes):
+        cal.offset_slopes = dict(entry.get('offset_slopes', {}))
+    if entry is not None:
+        previous = cal.iadc.registers.to_dict()
+        _write_registers(cal, entry['registers'])
+        decision = check_drift(measure_residuals(cal.adw), entry['residuals'], residuals)
+        if decision == 'full':
+            _write_registers(cal, previous)
+    cal.logger.info("ZDOK {z}: {d} calibration".format(z = cal.zdok_n, d = decision))
+    if decision == 'reuse':
+        return decision
+    routine(cal)
+    cal.adw.resample()
+    cache.store(board, cal.zdok_n, clock, cal.iadc.registers.to_dict(),
+                measure_residuals(cal.adw), temperature, cal.offset_slopes)
+    return decision
+
+def _write_registers(cal, registers):
+    """ Writes all of the registers of cal and waits for them to apply.
+    A capture is taken first so that an adaptive SettleDetector has
+    something to see the write change.
+    """
+    cal.adw.resample()
+    cal.iadc.registers.from_dict(registers)
+    cal.iadc.write_all_registers()
+    cal.settle.wait('warm_start', lambda: [cal.adw.get_offset(c) for c in ('I', 'Q')],
+                    lambda: [cal.adw.get_offset_error(c) for c in ('I', 'Q')])
@@ -3,11 +3,44 @@ Has the logic to perform the various calibration routines by reading data
 via a Snapshot class and modifying ADC parameters via and IAdc class
 """
 
+import json
 import logging
+import os
 import time
+import numpy as np
+from settle_detector import SettleDetector
+from iadc_register_map import OFFSET_STEP, OFFSET_MAX, OFFSET_MAX_CODE, ANALOGUE_GAIN_STEP, \
+    ANALOGUE_GAIN_MAX, GAIN_COMPENSATION_STEP, GAIN_COMPENSATION_MAX, FISDA_STEP, FISDA_MAX
+import metrics
+
+OFFSET_FIT_STEP = 4.0  # LSB between the two captures used to fit the offset slope
+
+def _quantise(value, step, limit):
+    """ Returns value clipped to [-limit; limit] and rounded to the nearest step
+    """
+    return round(min(max(value, -limit), limit) / step) * step
+
+def _reversal_freeze():
+    """ Returns settled(register, change), which is True if change should not
+    be made to register: either it is 0, or it would move the register back
+    the way it last came, which means the register is at the limit of the
+    noise. A register which has reversed is settled from then on.
+    """
+    directions = {}  # register -> sign of its last change. 0 once it has reversed
+    def settled(register, change):
+        if change == 0 or directions.get(register) == 0:
+            return True
+        if directions.get(register, np.sign(change)) != np.sign(change):
+            directions[register] = 0
+            return True
+        directions[register] = np.sign(change)
+        return False
+    return settled
 
 class Calibrator:
-    def __init__(self, iadc, adc_data_wrapper, interleaved=False, logger=logging.getLogger(__name__)):
+    def __init__(self, iadc, adc_data_wrapper, interleaved=False, offset_slopes=None,
+            settle_detector=None, confidence=None, max_captures=8, history=None,
+            logger=logging.getLogger(__name__)):
         """ Calibrator is contains logic for calibration routines
         
         iadc -- instance of IAdc which is used for modifying parameters
@@ -15,25 +48,134 @@ class Calibrator:
             same ADC ZDOK as iadc has.
         interleaved -- if True, read data interleaved from RF input I.
             If False, read I and Q seperately.
+        offset_slopes -- dict mapping 'I' and 'Q' to the change in mean per LSB
+            of offset as fitted by a previous #run_offset_cal_model. If given
+            the fit is skipped.
+        settle_detector -- SettleDetector which decides how long to wait after
+            each register write. Default: one which always waits 100 ms.
+        confidence -- if given, the stepping searches decide each step on an
+            average of just enough captures to know the sign of the error with
+            this confidence, up to max_captures. Default: None, meaning a
+            single capture per step.
+        history -- HistoryLog to which every iteration is appended. Default: None
         """
         self.logger = logger
         self.iadc = iadc
         self.zdok_n = iadc.zdok_n
         self.adw = adc_data_wrapper
         self.interleaved = interleaved
+        self.offset_slopes = dict(offset_slopes) if offset_slopes else {}
+        if settle_detector is None:
+            settle_detector = SettleDetector(adc_data_wrapper, mode='fixed', logger=logger.getChild('settle'))
+        self.settle = settle_detector
+        self.confidence = confidence
+        self.max_captures = max_captures
+        self.history = history
+        self._iterations = dict((register, metrics.REGISTRY.counter(
+            'calibrator_iterations_total', "Register writes made by the calibration loops",
+            zdok=self.zdok_n, register=register)) for register in ('offset', 'fisda', 'analogue_gain', 'gain_compensation', 'interleaved', 'joint'))
 
-    def run_offset_cal(self):
+    def run_offset_cal(self, search='step'):
         """ Performs offset calibration by attempting to ensure that both 
         I and Q have 0 mean.
+
+        search -- 'step' walks the offset in 0.25 LSB steps until the mean
+            changes sign. 'bisect' does a bisection search over the full
+            offset range. See #run_offset_cal_bisection_for_single_channel
+            'joint' steps I and Q together. See #run_offset_cal_joint
         """
+        assert(search in ('step', 'bisect', 'joint'))
         if self.interleaved == True:
-            self.snapshot.set_mode('inter')
-            # iadc.set_mode('inter')
-            self.run_offset_cal_for_single_channel('inter')
+            self.run_interleaved_cal(adjust=('offset',))
+        elif search == 'joint':
+            self.run_offset_cal_joint()
         else:
             for channel in ('I', 'Q'):
                 # iadc.set_mode...
-                self.run_offset_cal_for_single_channel(channel)
+                if search == 'bisect':
+                    self.run_offset_cal_bisection_for_single_channel(channel)
+                else:
+                    self.run_offset_cal_for_single_channel(channel)
+
+    def save_offset_slopes(self, filename):
+        """ Writes self.offset_slopes to filename as JSON so a later run can
+        skip the fit in #run_offset_cal_model
+        """
+        with open(filename, 'w') as f:
+            f.write(json.dumps(self.offset_slopes, sort_keys=True, indent=4))
+
+    def get_offset_slopes_from_file(self, filename):
+        """ Sets self.offset_slopes from a file written by #save_offset_slopes.
+        Does nothing if the file doesn't exist yet.
+        """
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.offset_slopes = json.loads(f.read())
+
+    def run_offset_cal_model(self):
+        """ Performs offset calibration of I and Q together by modelling the
+        offset DAC as linear. Each capture has both channels, so two captures at
+        different offsets give the slope of mean vs offset for each channel and
+        the offset which should give 0 mean. That offset gets written and a
+        third capture verifies it. The slopes are kept in self.offset_slopes so
+        that subsequent calls only need the first and last capture. See
+        #save_offset_slopes to keep them for later runs.
+
+        Returns a dict mapping channel to the final offset
+        """
+        registers = {'I': 'offset_vi', 'Q': 'offset_vq'}
+        self.adw.resample()
+        offsets = dict((c, self.iadc.registers[r]) for c, r in registers.items())
+        means = dict((c, self.adw.get_offset(c)) for c in registers)
+        for channel in registers:
+            self.logger.info("Before clibration, offset = {o} for channel {c}".format(
+                c = channel, o = means[channel]))
+        if set(self.offset_slopes) != set(registers):
+            # step each channel towards its zero and fit a line through the two points
+            fit_offsets = {}
+            for channel in registers:
+                step = -OFFSET_FIT_STEP if means[channel] > 0 else OFFSET_FIT_STEP
+                if self._clip_offset(offsets[channel] + step) == offsets[channel]:
+                    step = -step  # already at the end of the range
+                fit_offsets[channel] = self._clip_offset(offsets[channel] + step)
+                self.iadc.offset_set(channel, fit_offsets[channel])
+            self._settle_offset(registers.keys())
+            for channel in list(registers):
+                fit_mean = self.adw.get_offset(channel)
+                slope = (fit_mean - means[channel]) / (fit_offsets[channel] - offsets[channel])
+                if slope <= 0:
+                    self.logger.warn("Fitted offset slope of {s} for channel {c} is not positive. Falling back to bisection".format(
+                        s = slope, c = channel))
+                    self.run_offset_cal_bisection_for_single_channel(channel)
+                    del registers[channel]
+                    continue
+                self.offset_slopes[channel] = slope
+                offsets[channel] = fit_offsets[channel]
+                means[channel] = fit_mean
+                self.logger.debug("Fitted offset slope for channel {c}: {s}".format(c = channel, s = slope))
+        for channel in registers:
+            self.iadc.offset_set(channel, self._predict_zero_offset(channel, offsets[channel], means[channel]))
+        self._settle_offset(registers.keys())
+        for channel in registers:
+            # the verification capture only gets acted on if it is more than a step out
+            mean = self.adw.get_offset(channel)
+            offset = self.iadc.registers[registers[channel]]
+            corrected = self._predict_zero_offset(channel, offset, mean)
+            if corrected != offset:
+                self.iadc.offset_set(channel, corrected)
+            self.logger.info("After clibration, offset = {o} for channel {c}".format(c = channel, o = mean))
+        return dict((c, self.iadc.registers[r]) for c, r in (('I', 'offset_vi'), ('Q', 'offset_vq')))
+
+    def _predict_zero_offset(self, channel, offset, mean):
+        """ Uses the fitted slope for channel to find the offset setting, rounded
+        to the nearest step, which should give a mean of 0 given that offset
+        produced mean.
+        """
+        target = offset - (mean / self.offset_slopes[channel])
+        return self._clip_offset(round(target / OFFSET_STEP) * OFFSET_STEP)
+
+    def _clip_offset(self, value):
+        return min(max(value, -OFFSET_MAX), OFFSET_MAX)
 
     def run_offset_cal_for_single_channel(self, channel):
         """ The channel should have already been defined on the ADC and in the 
@@ -43,15 +185,14 @@ class Calibrator:
         channel -- what should be read from the snapshot block
         """
         self.adw.resample()
-        new_mean = self.adw.get_offset(channel) # should have a magnitute somewhere between 0 and 4
+        new_mean = self._offsets([channel])[channel] # should have a magnitute somewhere between 0 and 4
         self.logger.info("Before clibration, offset = {o} for channel {c}".format(c = channel, o = new_mean))
         if(new_mean > 0):  # we want to decrease the offset
             while(new_mean > 0):
                 assert(self.iadc.offset_dec(channel) == True) # should never hit bottom
                 last_mean = new_mean
-                time.sleep(0.1)  # some time for the change to 'apply'
-                self.adw.resample()
-                new_mean = self.adw.get_offset(channel)
+                self._settle_offset([channel])
+                new_mean = self._offsets([channel])[channel]
                 assert(new_mean < last_mean)
             # fix if we have gone too far
             if(abs(new_mean) > abs(last_mean)):
@@ -60,30 +201,125 @@ class Calibrator:
             while(new_mean < 0):
                 assert(self.iadc.offset_inc(channel) == True)
                 last_mean = new_mean
-                time.sleep(0.1)
-                self.adw.resample()
-                new_mean = self.adw.get_offset(channel)
+                self._settle_offset([channel])
+                new_mean = self._offsets([channel])[channel]
             if(abs(new_mean) > abs(last_mean)):
                self.iadc.offset_dec(channel)
-        time.sleep(0.1)
-        self.adw.resample()
+        self._settle_offset([channel])
         new_mean = self.adw.get_offset(channel)
         self.logger.info("After clibration, offset = {o} for channel {c}".format(c = channel, o = new_mean))
 
+    def run_offset_cal_joint(self):
+        """ Same logic as #run_offset_cal_for_single_channel but steps I and Q
+        together. Each iteration writes both offsets in one register write and
+        decides for each channel from the same capture. A channel stops
+        stepping once its mean has changed sign.
+        """
+        registers = {'I': 'offset_vi', 'Q': 'offset_vq'}
+        self.adw.resample()
+        new_means = self._offsets(registers.keys())
+        for channel in registers:
+            self.logger.info("Before clibration, offset = {o} for channel {c}".format(
+                c = channel, o = new_means[channel]))
+        # +1 to increase the offset, -1 to decrease it
+        directions = dict((c, (-1 if m > 0 else 1)) for c, m in new_means.items() if m != 0)
+        offsets = dict((c, self.iadc.registers[r]) for c, r in registers.items())
+        while directions:
+            for channel, direction in list(directions.items()):
+                new_offset = offsets[channel] + (direction * OFFSET_STEP)
+                if abs(new_offset) > OFFSET_MAX:
+                    self.logger.warn("Offset for channel {c} already at limit".format(c = channel))
+                    del directions[channel]
+                else:
+                    offsets[channel] = new_offset
+            if not directions:
+                break
+            self.iadc.offset_set_iq(offsets['I'], offsets['Q'])
+            last_means = dict(new_means)
+            self._settle_offset(directions.keys())
+            new_means.update(self._offsets(directions.keys()))
+            for channel, direction in list(directions.items()):
+                if (new_means[channel] * direction) >= 0:  # crossed 0
+                    del directions[channel]
+                    # fix if we have gone too far
+                    if abs(new_means[channel]) > abs(last_means[channel]):
+                        offsets[channel] -= direction * OFFSET_STEP
+        if ((offsets['I'] != self.iadc.registers['offset_vi']) or
+                (offsets['Q'] != self.iadc.registers['offset_vq'])):
+            self.iadc.offset_set_iq(offsets['I'], offsets['Q'])
+        self._settle_offset(registers.keys())
+        for channel in registers:
+            self.logger.info("After clibration, offset = {o} for channel {c}".format(
+                c = channel, o = self.adw.get_offset(channel)))
+
+    def run_offset_cal_bisection_for_single_channel(self, channel):
+        """ Finds the offset which gets the mean of the channel closest to 0 by
+        bisecting the range of offset codes. The mean increases with the offset
+        so the current setting brackets the zero crossing from one side and the
+        end of the range from the other. Takes about log2(254) captures.
+
+        channel -- 'I' or 'Q'
+        Returns a dict with the final 'offset' and 'mean' as well as the number
+        of 'captures' taken and the 'duration' in seconds.
+        """
+        assert(channel in ('I', 'Q'))
+        start = time.time()
+        register = {'I': 'offset_vi', 'Q': 'offset_vq'}[channel]
+        means = {}  # offset code -> measured mean
+        code = int(round(self.iadc.registers[register] / OFFSET_STEP))
+        self.adw.resample()
+        means[code] = self._offsets([channel])[channel]
+        self.logger.info("Before clibration, offset = {o} for channel {c}".format(c = channel, o = means[code]))
+        # invariant: the zero crossing lies in [low; high]
+        if means[code] > 0:
+            low, high = -OFFSET_MAX_CODE, code
+        else:
+            low, high = code, OFFSET_MAX_CODE
+        while (high - low) > 1:
+            mid = (low + high) // 2
+            means[mid] = self._measure_offset_at(channel, mid * OFFSET_STEP)
+            if means[mid] > 0:
+                high = mid
+            else:
+                low = mid
+        # the ends of the range may never have been visited
+        for end in (low, high):
+            if end not in means:
+                means[end] = self._measure_offset_at(channel, end * OFFSET_STEP)
+        best = min((low, high), key=lambda c: abs(means[c]))
+        if self.iadc.registers[register] != best * OFFSET_STEP:
+            self.iadc.offset_set(channel, best * OFFSET_STEP)
+        result = {
+            'offset': best * OFFSET_STEP,
+            'mean': means[best],
+            'captures': len(means),
+            'duration': time.time() - start,
+        }
+        self.logger.info("After clibration, offset = {o} for channel {c}".format(c = channel, o = result['mean']))
+        self.logger.info("Bisection offset calibration for channel {c} took {n} captures in {t:.2f} s".format(
+            c = channel, n = result['captures'], t = result['duration']))
+        return result
+
+    def _measure_offset_at(self, channel, value):
+        """ Sets the offset of channel to value and returns the resulting mean
+        """
+        self.iadc.offset_set(channel, value)
+        self._settle_offset([channel])
+        return self._offsets([channel])[channel]
+
     def run_phase_difference_cal(self, interleaved=False):
         """ Attempts to get the phase difference between the channels
         down to 0
         """
         self.adw.resample()
-        new_phase = self.adw.get_phase_difference()
+        new_phase = self._phase_difference()
         self.logger.info("Before clibration phase difference = {p}".format(p = new_phase))
         if(new_phase > 0):  # I ahead of Q. 
             while(new_phase > 0):
                 assert(self.iadc.fisda_inc() == True) # decrease the Q delay (advance Q)
                 last_phase = new_phase
-                time.sleep(0.1)  # some time for the change to 'apply'
-                self.adw.resample()
-                new_phase = self.adw.get_phase_difference()
+                self._settle_phase()
+                new_phase = self._phase_difference()
                 assert(new_phase < last_phase)
             # fix if we have gone too far
             if(abs(new_phase) > abs(last_phase)):
@@ -92,48 +328,276 @@ class Calibrator:
             while(new_phase < 0):
                 assert(self.iadc.fisda_dec() == True)  # delay Q. 
                 last_phase = new_phase
-                time.sleep(0.1)
-                self.adw.resample()
-                new_phase = self.adw.get_phase_difference()
+                self._settle_phase()
+                new_phase = self._phase_difference()
             if(abs(new_phase) > abs(last_phase)):
                self.iadc.fisda_inc()
-        time.sleep(0.1)
-        self.adw.resample()
+        self._settle_phase()
         new_phase = self.adw.get_phase_difference()
         self.logger.info("After calibration phase difference: {ph}".format(ph = new_phase))
 
-    def run_analogue_gain_cal(self, interleaved=False):
-        """Attempts to get the sum of the squared output values to be equal for each channel.
-        """
-        raise Exception("Not really implemented properly yet...")
-        self.snapshot.set_mode('IQ')
-        sums_squared = self.snapshot.get_sum_squared()
-        channel_I_sum = sums_squared['I']
-        channel_Q_sum = sums_squared['Q']
-        self.logger.info("Before calibration, channel I sum squared: {i}, channel Q sum squared: {q}, difference: {d}".format(
-            i = channel_I_sum, q = channel_Q_sum, d = abs(channel_I_sum - channel_Q_sum)))
-        # increment the smaller and decrement the larger until approximately equal.
-        while(channel_I_sum > channel_Q_sum):
-            self.iadc.analogue_gain_dec('I')
-            channel_I_sum = self.snapshot.get_sum_squared()['I']
-            if(channel_I_sum > channel_Q_sum):
-                self.iadc.analogue_gain_inc('Q')
-                channel_Q_sum = self.snapshot.get_sum_squared()['Q']
-        while(channel_I_sum < channel_Q_sum):
-            self.iadc.analogue_gain_inc('I')
-            channel_I_sum = self.snapshot.get_sum_squared()['I']
-            if(channel_I_sum < channel_Q_sum):
-                self.iadc.analogue_gain_dec('Q')
-                channel_Q_sum = self.snapshot.get_sum_squared()['Q']
-        # channel_I must now be greater than channel_Q
-        before_difference = channel_I_sum - channel_Q_sum
-        self.iadc.analogue_gain_inc('Q')
-        channel_Q_sum = self.snapshot.get_sum_squared()['Q']
-        after_difference = abs(channel_Q_sum - channel_I_sum)  # abs just in case it's marginally greater (approx equal)
-        if(before_difference < after_difference):  # if going lower was a bad idea...
-            self.iadc.analogue_gain_dec('Q')  # ...go back up
-        sums_squared = self.snapshot.get_sum_squared()
-        channel_I_sum = sums_squared['I']
-        channel_Q_sum = sums_squared['Q']
-        self.logger.info("After calibration, channel I sum squared: {i}, channel Q sum squared: {q}, difference: {d}".format(
-            i = channel_I_sum, q = channel_Q_sum, d = abs(channel_I_sum - channel_Q_sum)))
+    def _offsets(self, channels):
+        """ Returns a dict mapping each of channels to its offset. This is
+        from the current capture unless self.confidence is set.
+        """
+        if self.confidence is None:
+            return dict((c, self.adw.get_offset(c)) for c in channels)
+        return self.adw.get_offset_streaming(list(channels), self.confidence, self.max_captures)
+
+    def _phase_difference(self):
+        """ Returns the phase difference between I and Q. This is from the
+        current capture unless self.confidence is set.
+        """
+        if self.confidence is None:
+            return self.adw.get_phase_difference()
+        return self.adw.get_phase_difference_streaming(self.confidence, self.max_captures)
+
+    def _settle(self, register, statistic, error):
+        """ Waits for a write to register to apply, resamples and records the
+        iteration. See SettleDetector#wait
+        """
+        self._iterations[register].inc()
+        self.settle.wait(register, statistic, error)
+        if self.history is not None:
+            # the phase needs an FFT so is only recorded when it is being calibrated
+            phase = self.adw.get_phase_difference() if register in ('fisda', 'interleaved', 'joint') else float('nan')
+            self.history.append(self.zdok_n, register, self.iadc.registers,
+                                dict((c, self.adw.get_offset(c)) for c in ('I', 'Q')),
+                                dict((c, self.adw.get_power(c)) for c in ('I', 'Q')), phase)
+
+    def _settle_offset(self, channels):
+        """ Waits for an offset write to apply and resamples
+        """
+        channels = list(channels)
+        self._settle('offset',
+                     lambda: [self.adw.get_offset(c) for c in channels],
+                     lambda: [self.adw.get_offset_error(c) for c in channels])
+
+    def _settle_phase(self):
+        """ Waits for a FiSDA write to apply and resamples
+        """
+        self._settle('fisda', self.adw.get_phase_difference, self.adw.get_phase_error)
+
+    def run_phase_difference_cal_direct(self, tone_freq=None, max_attempts=3):
+        """ Gets the phase difference between the channels to 0 by converting
+        it to a delay at the tone frequency and jumping FiSDA straight there.
+        One capture then checks the result. At high tone frequencies a phase
+        may correspond to several delays within the FiSDA range, one per
+        cycle, so if the check fails the next closest delay is tried.
+
+        tone_freq -- actual frequency of the tone in Hz. Needed if the tone
+            is beyond the first Nyquist zone. Default: the measured frequency.
+        max_attempts -- maximum number of candidate delays to try
+        Returns the final phase difference in radians
+        """
+        self.adw.resample()
+        phase = self.adw.get_phase_difference()
+        self.logger.info("Before clibration phase difference = {p}".format(p = phase))
+        if tone_freq is None:
+            tone_freq = self.adw.get_tone_frequency()
+        elif int(2 * tone_freq / self.adw.fs) % 2 == 1:
+            phase = -phase  # the spectrum is mirrored in even Nyquist zones
+        if tone_freq <= 0:
+            self.logger.warn("No tone found. Cannot calibrate phase difference")
+            return phase
+        start = self.iadc.registers['fisda_q']
+        # a positive phase is cancelled by increasing FiSDA
+        period = 1e12 / tone_freq  # ps
+        delay = (phase / (2 * np.pi)) * period
+        cycles = int(np.ceil((2 * FISDA_MAX) / period))
+        candidates = set()
+        for cycle in range(-cycles, cycles + 1):
+            fisda = int(round((start + delay + (cycle * period)) / FISDA_STEP)) * FISDA_STEP
+            if abs(fisda) <= FISDA_MAX:
+                candidates.add(fisda)
+        candidates = sorted(candidates, key=lambda f: abs(f - start))[:max_attempts]
+        # half a FiSDA step's worth of phase
+        tolerance = np.pi * FISDA_STEP / period
+        for fisda in candidates:
+            if fisda != self.iadc.registers['fisda_q']:
+                self.iadc.fisda_set(fisda)
+                self._settle_phase()
+            phase = self.adw.get_phase_difference()
+            if abs(phase) <= tolerance:
+                break
+            self.logger.debug("FiSDA of {f} ps left phase difference of {p}".format(f = fisda, p = phase))
+        self.logger.info("After calibration phase difference: {ph}".format(ph = phase))
+        return phase
+
+    def run_analogue_gain_cal(self, interleaved=False, max_verifications=2):
+        """ Attempts to get the AC power of I and Q to be equal.
+        The I/Q AC power ratio in dB from a single capture is the correction
+        needed, so half of it is taken off the I gain and half added to the Q
+        gain in one write. The AC power leaves out the offsets, which would
+        otherwise bias the ratio by up to 0.2 dB until they are calibrated.
+        Up to max_verifications captures then check the result, each one
+        correcting again if it is out by more than a step.
+        """
+        self.adw.resample()
+        ratio = self.adw.get_core_gain_mismatch()
+        self.logger.info("Before calibration, I/Q power ratio: {r} dB".format(r = ratio))
+        for verification in range(max_verifications):
+            if abs(ratio) < ANALOGUE_GAIN_STEP:
+                break
+            self._jump_analogue_gain(ratio)
+            self._settle_analogue_gain()
+            ratio = self.adw.get_core_gain_mismatch()
+            self.logger.debug("I/Q power ratio: {r} dB".format(r = ratio))
+        self.logger.info("After calibration, I/Q power ratio: {r} dB".format(r = ratio))
+        return ratio
+
+    def _jump_analogue_gain(self, ratio):
+        """ Adjusts the analogue gains to cancel an I/Q power ratio of ratio dB,
+        splitting the correction between the channels.
+        """
+        limit = ANALOGUE_GAIN_MAX
+        gain_i = self.iadc.registers['analogue_gain_vi']
+        gain_q = self.iadc.registers['analogue_gain_vq']
+        new_i = min(max(gain_i - (ratio / 2.0), -limit), limit)
+        # whatever I couldn't take goes on Q
+        new_q = min(max(gain_q + (ratio - (gain_i - new_i)), -limit), limit)
+        new_i = round(new_i / ANALOGUE_GAIN_STEP) * ANALOGUE_GAIN_STEP
+        new_q = round(new_q / ANALOGUE_GAIN_STEP) * ANALOGUE_GAIN_STEP
+        with self.iadc.transaction():
+            self.iadc.analogue_gain_set('I', new_i)
+            self.iadc.analogue_gain_set('Q', new_q)
+
+    def _settle_analogue_gain(self):
+        """ Waits for an analogue gain write to apply and resamples
+        """
+        self._settle('analogue_gain', self.adw.get_core_gain_mismatch, self.adw.get_core_gain_mismatch_error)
+
+    def run_gain_compensation_cal(self):
+        """ Matches the gain of the Q core to the I core for interleaved mode.
+        Both cores sample the same input in inter_I or inter_Q mode so the
+        ratio of their AC powers from one capture is the gain mismatch in dB.
+        The gain compensation is set to cancel it in a single write and a
+        second capture checks the result.
+        Returns the remaining mismatch in dB
+        """
+        mode = self.iadc.registers['control'].get_analogue_selection()
+        if mode not in ('inter_I', 'inter_Q'):
+            self.logger.warn("Gain compensation calibration expects an interleaved mode but ADC is in {m}".format(m = mode))
+        self.adw.resample()
+        mismatch = self.adw.get_core_gain_mismatch()
+        self.logger.info("Before calibration, core gain mismatch: {g} dB".format(g = mismatch))
+        value = _quantise(self.iadc.registers['gain_compensation_vq'] + mismatch,
+                          GAIN_COMPENSATION_STEP, GAIN_COMPENSATION_MAX)
+        self.iadc.gain_compensation_set('Q', value)
+        self._settle('gain_compensation', self.adw.get_core_gain_mismatch, self.adw.get_core_gain_mismatch_error)
+        mismatch = self.adw.get_core_gain_mismatch()
+        self.logger.info("After calibration, core gain mismatch: {g} dB".format(g = mismatch))
+        return mismatch
+
+    def run_interleaved_cal(self, adjust=('offset', 'gain_compensation', 'fisda'), max_iterations=5):
+        """ Calibrates the cores against each other for interleaved mode. Each
+        iteration estimates the offset, gain and timing mismatches from one
+        capture (see AdcDataWrapper#get_interleave_mismatch) and corrects
+        all of them in one transaction. As in #run_joint_cal, a register which
+        would be moved back the way it came is at the limit of the noise, so is
+        left alone from then on. Stops once no register needs to change.
+        The ADC should be in inter_I or inter_Q mode with clock selection 'neg'.
+
+        adjust -- which of 'offset', 'gain_compensation' and 'fisda' to correct
+        Returns the mismatch dict from the last capture
+        """
+        registers = self.iadc.registers
+        settled = _reversal_freeze()
+        self.adw.resample()
+        mismatch = self.adw.get_interleave_mismatch()
+        self.logger.info("Before calibration, interleave mismatch: {m}".format(m = mismatch))
+        for iteration in range(max_iterations):
+            targets = {}
+            if 'offset' in adjust:
+                targets['offset_vi'] = _quantise(
+                    registers['offset_vi'] - (mismatch['offset_I'] / self.offset_slopes.get('I', 1.0)),
+                    OFFSET_STEP, OFFSET_MAX)
+                targets['offset_vq'] = _quantise(
+                    registers['offset_vq'] - (mismatch['offset_Q'] / self.offset_slopes.get('Q', 1.0)),
+                    OFFSET_STEP, OFFSET_MAX)
+            if 'gain_compensation' in adjust:
+                targets['gain_compensation_vq'] = _quantise(
+                    registers['gain_compensation_vq'] + mismatch['gain_mismatch'],
+                    GAIN_COMPENSATION_STEP, GAIN_COMPENSATION_MAX)
+            if 'fisda' in adjust:
+                targets['fisda_q'] = _quantise(
+                    registers['fisda_q'] - (mismatch['timing_mismatch'] * 1e12), FISDA_STEP, FISDA_MAX)
+            changed = dict((name, value) for name, value in targets.items()
+                           if not settled(name, value - registers[name] if abs(value - registers[name]) > 1e-9 else 0))
+            if not changed:
+                break
+            with self.iadc.transaction():
+                if ('offset_vi' in changed) or ('offset_vq' in changed):
+                    self.iadc.offset_set_iq(changed.get('offset_vi', registers['offset_vi']),
+                                            changed.get('offset_vq', registers['offset_vq']))
+                if 'gain_compensation_vq' in changed:
+                    self.iadc.gain_compensation_set('Q', changed['gain_compensation_vq'])
+                if 'fisda_q' in changed:
+                    self.iadc.fisda_set(changed['fisda_q'])
+            self._settle('interleaved',
+                         lambda: [self.adw.get_interleave_mismatch()[k] for k in ('offset_I', 'offset_Q')],
+                         lambda: [self.adw.get_offset_error(c) for c in ('I', 'Q')])
+            mismatch = self.adw.get_interleave_mismatch()
+            self.logger.debug("Interleave mismatch after iteration {i}: {m}".format(i = iteration, m = mismatch))
+        self.logger.info("After calibration, interleave mismatch: {m}".format(m = mismatch))
+        return mismatch
+
+    def run_joint_cal(self, tone_freq=None, max_iterations=6):
+        """ Calibrates the offsets, the analogue gains and FiSDA together in
+        independent mode. Each capture gives the offset of each channel, the
+        gain mismatch and the phase difference. Every register whose error is
+        more than half a step is jumped to cancel it, all in one transaction,
+        and the next capture checks the result. A register which would be moved
+        back the way it came is at the limit of the noise, so is left alone from
+        then on. Stops once no register needs to change.
+        The gain mismatch is taken from the AC powers so that it is not thrown
+        by the offsets changing at the same time. The phase difference is
+        cancelled with the delay closest to the current FiSDA. See
+        #run_phase_difference_cal_direct if the tone is at a high frequency.
+
+        tone_freq -- actual frequency of the tone in Hz. Default: the measured frequency
+        Returns a dict with the final offset_I, offset_Q, gain_mismatch and phase
+        """
+        registers = self.iadc.registers
+        statistics = lambda: [self.adw.get_offset('I'), self.adw.get_offset('Q'),
+                              self.adw.get_core_gain_mismatch(), self.adw.get_phase_difference()]
+        errors = lambda: [self.adw.get_offset_error('I'), self.adw.get_offset_error('Q'),
+                          self.adw.get_core_gain_mismatch_error(), self.adw.get_phase_error()]
+        settled = _reversal_freeze()
+        self.adw.resample()
+        residuals = statistics()
+        self.logger.info("Before calibration, offsets, gain mismatch and phase: {r}".format(r = residuals))
+        for iteration in range(max_iterations):
+            offset_i, offset_q, mismatch, phase = residuals
+            new_i = _quantise(registers['offset_vi'] - (offset_i / self.offset_slopes.get('I', 1.0)),
+                              OFFSET_STEP, OFFSET_MAX)
+            new_q = _quantise(registers['offset_vq'] - (offset_q / self.offset_slopes.get('Q', 1.0)),
+                              OFFSET_STEP, OFFSET_MAX)
+            if settled('offset_vi', new_i - registers['offset_vi']):
+                new_i = registers['offset_vi']
+            if settled('offset_vq', new_q - registers['offset_vq']):
+                new_q = registers['offset_vq']
+            change_offset = (new_i != registers['offset_vi']) or (new_q != registers['offset_vq'])
+            change_gain = not settled('analogue_gain', -mismatch if abs(mismatch) >= ANALOGUE_GAIN_STEP else 0)
+            frequency = tone_freq if tone_freq is not None else self.adw.get_tone_frequency()
+            new_fisda = registers['fisda_q']
+            if frequency > 0:
+                # a positive phase is cancelled by increasing FiSDA
+                delay = (phase / (2 * np.pi)) * (1e12 / frequency)
+                new_fisda = _quantise(registers['fisda_q'] + delay, FISDA_STEP, FISDA_MAX)
+            change_fisda = not settled('fisda_q', new_fisda - registers['fisda_q'])
+            if not (change_offset or change_gain or change_fisda):
+                break
+            with self.iadc.transaction():
+                if change_offset:
+                    self.iadc.offset_set_iq(new_i, new_q)
+                if change_gain:
+                    self._jump_analogue_gain(mismatch)
+                if change_fisda:
+                    self.iadc.fisda_set(new_fisda)
+            self._settle('joint', statistics, errors)
+            residuals = statistics()
+            self.logger.debug("Offsets, gain mismatch and phase after iteration {i}: {r}".format(
+                i = iteration, r = residuals))
+        self.logger.info("After calibration, offsets, gain mismatch and phase: {r}".format(r = residuals))
+        return dict(zip(('offset_I', 'offset_Q', 'gain_mismatch', 'phase'), residuals))
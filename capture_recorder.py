@@ -0,0 +1,136 @@
+"""
+Records the captures seen by an AdcDataWrapper to a file and replays them
+in place of a Correlator, so that the calibration logic can be rerun and
+profiled offline against real data.
+
+The file is a RecordFile of fixed size records, each holding the I and Q
+samples of one capture and the register values at the time. Records are
+only ever appended and #load memory maps them:
+
+    iadc = IAdc(correlator.fpga, 0)
+    recorder = CaptureRecorder('captures_0.bin', iadc.registers)
+    adw = AdcDataWrapper(correlator, 0, recorder=recorder)
+    (calibrate)
+
+    replay = ReplayCorrelator('captures_0.bin')
+    iadc = IAdc(replay.fpga, 0)
+    adw = AdcDataWrapper(replay, 0)
+    (calibrate again, at disk speed)
+"""
+
+import logging
+import threading
+import time
+import numpy as np
+from history_log import REGISTERS
+from record_file import RecordFile
+
+MAGIC = b'IADCSNAP'
+VERSION = 1  # the header holds the number of samples per channel
+
+def record_dtype(num_samples):
+    """ Returns the dtype of a record holding num_samples per channel
+    """
+    return np.dtype(
+        [('timestamp', '<f8'),  # seconds since the epoch
+         ('zdok', '<u1'),
+         ('control', '<u2')] +
+        [(name, '<f4') for name in REGISTERS] +
+        [('I', 'i1', (num_samples,)),
+         ('Q', 'i1', (num_samples,))])
+
+class CaptureRecorder(object):
+    def __init__(self, filename, registers, logger=logging.getLogger(__name__)):
+        """ Appends captures to filename, creating it if needed. All captures
+        in a file must have the same number of samples.
+
+        registers -- IAdcRegisters of the ADC being captured, which are
+            recorded along with each capture
+        """
+        self.logger = logger
+        self.filename = filename
+        self.registers = registers
+        self._lock = threading.Lock()
+        self._file = _record_file(filename)
+        self._dtype = None
+        if self._file.exists():
+            self._dtype = record_dtype(self._file.read_header())
+
+    def record(self, zdok_n, sig_i, sig_q):
+        """ Appends the I and Q samples of a capture with the current registers
+        """
+        num_samples = min(len(sig_i), len(sig_q))
+        with self._lock:
+            if self._dtype is None:
+                self._file.create(num_samples)
+                self._dtype = record_dtype(num_samples)
+            if num_samples != self._dtype['I'].shape[0]:
+                raise ValueError("Capture of {n} samples doesn't fit {f} which holds {m} per channel".format(
+                    n = num_samples, f = self.filename, m = self._dtype['I'].shape[0]))
+            record = np.zeros(1, dtype=self._dtype)
+            record['timestamp'] = time.time()
+            record['zdok'] = zdok_n
+            record['control'] = self.registers['control'].value
+            for name in REGISTERS:
+                record[name] = self.registers[name]
+            record['I'] = sig_i[:num_samples]
+            record['Q'] = sig_q[:num_samples]
+            self._file.append(record)
+
+def _record_file(filename):
+    return RecordFile(filename, MAGIC, VERSION, 'capture file')
+
+def load(filename):
+    """ Returns the records in filename as a read only, memory mapped
+    structured array. A partly written last record is ignored.
+    """
+    record_file = _record_file(filename)
+    return record_file.load(record_dtype(record_file.read_header()))
+
+class ReplayFpga(object):
+    """ Stands in for the FpgaClient of a ReplayCorrelator. Register writes
+    are counted and otherwise ignored.
+    """
+    def __init__(self, fs=800e6):
+        self.fs = fs
+        self.writes = 0
+
+    def blindwrite(self, device_name, data, offset=0):
+        self.writes += 1
+
+    def read(self, device_name, size, offset=0):
+        return b'\x00' * size
+
+    def est_brd_clk(self):
+        return self.fs / 4 / 1e6
+
+class ReplayCorrelator(object):
+    def __init__(self, filename, loop=False, fs=800e6, logger=logging.getLogger(__name__)):
+        """ Stands in for directionFinder_backend.correlator.Correlator,
+        serving the captures in filename in the order they were recorded.
+        The replayed data doesn't respond to register writes.
+
+        loop -- if True, starts again from the first capture after the last.
+            Otherwise running out of captures raises EOFError
+        """
+        self.logger = logger
+        self.filename = filename
+        self.loop = loop
+        self.fpga = ReplayFpga(fs)
+        self.records = load(filename)
+        self.snapshots = 0
+        self.record = None  # the record being served
+        self.time_domain_signals = None
+
+    def fetch_time_domain_snapshot(self, force=False):
+        if self.snapshots >= len(self.records):
+            if (not self.loop) or (len(self.records) == 0):
+                raise EOFError("All {n} captures in {f} have been replayed".format(
+                    n = len(self.records), f = self.filename))
+        self.record = self.records[self.snapshots % len(self.records)]
+        zdok_n = int(self.record['zdok'])
+        signals = [None] * (2 * (zdok_n + 1))
+        signals[2 * zdok_n] = self.record['I']
+        signals[(2 * zdok_n) + 1] = self.record['Q']
+        self.time_domain_signals = signals
+        self.snapshots += 1
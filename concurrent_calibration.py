@@ -0,0 +1,166 @@
+"""
+Runs Calibrator instances for several ADC ZDOKs at the same time.
+
+The ADCs share a single FPGA client and a single Correlator. Access to the
+FPGA is serialised with a lock and every snapshot captures all channels, so
+at each step one capture is shared by all of the calibrators. Most of the
+time in a calibration is spent sleeping and waiting on snapshots, which can
+then overlap between the ADCs.
+"""
+
+import logging
+import threading
+import numpy as np
+from iadc import IAdc
+from adc_data_wrapper import AdcDataWrapper
+from calibrator import Calibrator
+from settle_detector import SettleDetector
+from capture_recorder import CaptureRecorder
+
+class SerialisedFpga(object):
+    def __init__(self, fpga, lock):
+        """ Wraps an FpgaClient such that only one thread uses it at a time
+
+        fpga -- corr.katcp_wrapper.FpgaClient instance
+        lock -- threading.RLock which is also held while capturing snapshots
+        """
+        self._fpga = fpga
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._fpga, name)
+        if not callable(attr):
+            return attr
+        def serialised(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return serialised
+
+class SharedCapture(object):
+    def __init__(self, correlator, lock):
+        """ Stands in for the Correlator of several AdcDataWrappers.
+        A new snapshot is only fetched once every participant has asked for
+        one, so all of them get the same capture.
+
+        correlator -- instance of directionFinder_backend.correlator.Correlator
+        lock -- threading.RLock which serialises access to the FPGA
+        """
+        self.correlator = correlator
+        self.lock = lock
+        self._condition = threading.Condition()
+        self._participants = 0
+        self._waiting = 0
+        self._signals = None  # copy of the signals of the last shared capture
+        self.generation = 0
+
+    @property
+    def time_domain_signals(self):
+        """ The signals of the last shared capture. These are kept apart from
+        the Correlator so that other captures from it, such as those of a
+        DriftMonitor, don't change them under the participants.
+        """
+        if self._signals is None:
+            return self.correlator.time_domain_signals
+        return self._signals
+
+    def join(self):
+        """ Registers a participant which will take part in every capture
+        """
+        with self._condition:
+            self._participants += 1
+
+    def leave(self):
+        """ Removes a participant. If the others are all waiting this triggers
+        the capture they are waiting for.
+        """
+        with self._condition:
+            self._participants -= 1
+            if (self._waiting > 0) and (self._waiting >= self._participants):
+                self._capture()
+
+    def fetch_time_domain_snapshot(self, force=True):
+        """ Blocks until all participants have asked for a new snapshot
+        """
+        with self._condition:
+            generation = self.generation
+            self._waiting += 1
+            if self._waiting >= self._participants:
+                self._capture()
+            else:
+                while self.generation == generation:
+                    self._condition.wait()
+
+    def _capture(self):
+        # must be called with self._condition held
+        with self.lock:
+            self.correlator.fetch_time_domain_snapshot(force=True)
+            self._signals = [None if signal is None else np.array(signal)
+                             for signal in self.correlator.time_domain_signals]
+        self._waiting = 0
+        self.generation += 1
+        self._condition.notify_all()
+
+def build_calibrators(correlator, zdoks, mode='indep', interleaved=False, settle_mode='fixed',
+                      settle_filename=None, history=None, capture_filename=None,
+                      logger=logging.getLogger(__name__)):
+    """ Creates a Calibrator for each ZDOK, all sharing the correlator and its FPGA client
+
+    correlator -- instance of directionFinder_backend.correlator.Correlator
+    zdoks -- iterable of ZDOK numbers to calibrate
+    settle_mode -- 'fixed' or 'adaptive'. See SettleDetector
+    settle_filename -- file in which to persist learnt settle times.
+        Formatted with zdok_n. eg: 'settle_times_{zdok_n}.json'
+    history -- HistoryLog shared by all of the calibrators. Default: None
+    capture_filename -- file in which to record every capture. Formatted
+        with zdok_n. Default: None, which means captures are not recorded
+    Returns a list of Calibrators in the same order as zdoks
+    """
+    lock = threading.RLock()
+    fpga = SerialisedFpga(correlator.fpga, lock)
+    capture = SharedCapture(correlator, lock)
+    calibrators = []
+    for zdok_n in zdoks:
+        iadc = IAdc(fpga, zdok_n = zdok_n, mode = mode, logger = logger.getChild('iadc{n}'.format(n = zdok_n)))
+        recorder = None
+        if capture_filename:
+            recorder = CaptureRecorder(capture_filename.format(zdok_n = zdok_n), iadc.registers,
+                                       logger = logger.getChild('recorder{n}'.format(n = zdok_n)))
+        adw = AdcDataWrapper(capture, zdok_n, recorder = recorder,
+                             logger = logger.getChild('adw{n}'.format(n = zdok_n)))
+        settle = SettleDetector(adw, mode = settle_mode,
+                                filename = settle_filename.format(zdok_n = zdok_n) if settle_filename else None,
+                                logger = logger.getChild('settle{n}'.format(n = zdok_n)))
+        calibrators.append(Calibrator(iadc, adw, interleaved = interleaved, settle_detector = settle, history = history,
+                                      logger = logger.getChild('calibrator{n}'.format(n = zdok_n))))
+    return calibrators
+
+def run_concurrently(calibrators, routine):
+    """ Runs routine for each of the calibrators in its own thread and waits
+    for all of them to finish. The calibrators must have been created by
+    #build_calibrators so that they share a capture.
+
+    routine -- callable taking a Calibrator. For example:
+        lambda cal: cal.run_offset_cal()
+    Returns a list of what routine returned for each calibrator.
+    Re-raises the first exception raised by any routine.
+    """
+    results = [None] * len(calibrators)
+    errors = []
+    for cal in calibrators:
+        cal.adw.correlator.join()
+    def run(idx, cal):
+        try:
+            results[idx] = routine(cal)
+        except Exception as e:
+            cal.logger.exception("Calibration of ZDOK {z} failed".format(z = cal.zdok_n))
+            errors.append(e)
+        finally:
+            cal.adw.correlator.leave()
+    threads = [threading.Thread(target=run, args=(idx, cal)) for idx, cal in enumerate(calibrators)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,164 @@
+"""
+Keeps a calibrated ADC calibrated as it drifts, without interrupting
+observations for a full recalibration.
+
+Every interval a DriftMonitor merges a few captures into a
+StreamingStatistics and looks at the offsets, the I/Q power ratio and the
+phase difference. Each which has drifted outside its hysteresis band is
+trimmed back by a single register step. Trimming continues, one step per
+sample, until the statistic is back within the inner edge of the band.
+Samples are captured on their own rather than through the SharedCapture
+of the calibrators, and the FPGA lock is only held for each capture and
+for the trims, so the monitor can run alongside calibration of the other
+ZDOKs and the correlator has the FPGA the rest of the time.
+"""
+
+import logging
+import threading
+import time
+import numpy as np
+import metrics
+from adc_data_wrapper import AdcDataWrapper, z_score
+from iadc_register_map import FISDA_STEP
+
+# statistic -> (stop trimming below, start trimming above). The inner edge
+# is at least half a register step so a trim can't overshoot the band.
+HYSTERESIS = {
+    'offset': (0.125, 0.5),  # LSB
+    'power_ratio': (0.011, 0.05),  # dB
+    'phase': (0.5, 2.0),  # FiSDA steps, ie: multiples of the phase of 4 ps at the tone frequency
+}
+
+class _LockedCapture(object):
+    def __init__(self, correlator, lock):
+        """ Stands in for the Correlator of the monitor's AdcDataWrapper.
+        Snapshots are fetched with lock held and copied, so they don't wait
+        on a SharedCapture and aren't overwritten by other threads' captures.
+        """
+        self.correlator = correlator
+        self.lock = lock
+        self.time_domain_signals = None
+
+    def fetch_time_domain_snapshot(self, force=True):
+        with self.lock:
+            self.correlator.fetch_time_domain_snapshot(force=True)
+            self.time_domain_signals = [None if signal is None else np.array(signal)
+                                        for signal in self.correlator.time_domain_signals]
+
+class DriftMonitor(object):
+    def __init__(self, calibrator, interval=10.0, captures=4, confidence=0.95,
+                 hysteresis=HYSTERESIS, registers=('offset', 'analogue_gain', 'fisda'), lock=None, logger=logging.getLogger(__name__)):
+        """ Monitors the ADC of a Calibrator which has already been calibrated
+        in independent mode.
+
+        interval -- seconds between samples
+        captures -- captures merged for each sample
+        confidence -- a statistic is only trimmed if its sign is known with
+            this confidence, so noise alone doesn't cause trims
+        hysteresis -- dict in the form of HYSTERESIS
+        registers -- which registers to trim. Leave out 'fisda' if there is no tone
+        lock -- held while capturing and trimming. Default: the lock of the
+            SharedCapture if the calibrator was made by build_calibrators
+        """
+        self.logger = logger
+        self.cal = calibrator
+        self.interval = interval
+        self.captures = captures
+        self.z = z_score(confidence)
+        self.hysteresis = hysteresis
+        self.registers = registers
+        self.lock = lock if lock is not None else getattr(calibrator.adw.correlator, 'lock', None)
+        self.adw = calibrator.adw
+        if self.lock is not None:
+            # capture straight from the Correlator behind any SharedCapture
+            correlator = getattr(calibrator.adw.correlator, 'correlator', calibrator.adw.correlator)
+            self.adw = AdcDataWrapper(_LockedCapture(correlator, self.lock), calibrator.zdok_n,
+                                      fs = calibrator.adw.fs, track_tone = calibrator.adw.track_tone,
+                                      logger = logger.getChild('adw'))
+        self._trim_lock = self.lock if self.lock is not None else threading.Lock()
+        self._trimming = set()  # statistics currently outside the inner edge of their band
+        self._stop = threading.Event()
+        self._thread = None
+        self._trims = dict((register, metrics.REGISTRY.counter(
+            'drift_monitor_trims_total', "Single step corrections made by the drift monitor",
+            zdok=calibrator.zdok_n, register=register)) for register in registers)
+
+    def start(self):
+        """ Starts monitoring in a daemon thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='drift_monitor{z}'.format(z = self.cal.zdok_n))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops monitoring and waits for the current sample to finish
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        """ Samples and trims every interval until stopped
+        """
+        while not self._stop.is_set():
+            start = time.time()
+            try:
+                self.step()
+            except Exception:
+                self.logger.exception("Drift monitor sample failed on ZDOK {z}".format(z = self.cal.zdok_n))
+            self._stop.wait(max(self.interval - (time.time() - start), 0))
+
+    def _outside(self, name, statistic, value, error, scale=1.0):
+        """ Returns True if value should be trimmed, given the hysteresis band
+        of statistic and whether it is already being trimmed
+
+        scale -- the band is multiplied by this
+        """
+        inner, outer = [edge * scale for edge in self.hysteresis[name]]
+        threshold = inner if statistic in self._trimming else outer
+        if (abs(value) > threshold) and (abs(value) > self.z * error):
+            self._trimming.add(statistic)
+            return True
+        self._trimming.discard(statistic)
+        return False
+
+    def step(self):
+        """ Takes one sample and trims each statistic which has drifted by a
+        single register step, all in one transaction.
+        Returns a dict mapping each trimmed statistic to its value
+        """
+        iadc = self.cal.iadc
+        self.adw.resample()
+        stats = self.adw.stream(lambda st: False, self.captures, with_spectra=('fisda' in self.registers))
+        trimmed = {}
+        with self._trim_lock, iadc.transaction():
+            for channel in (('I', 'Q') if 'offset' in self.registers else ()):
+                offset = stats.get_offset(channel)
+                if self._outside('offset', 'offset_' + channel, offset, stats.get_offset_error(channel)):
+                    if (iadc.offset_dec(channel) if offset > 0 else iadc.offset_inc(channel)):
+                        self._trims['offset'].inc()
+                        trimmed['offset_' + channel] = offset
+            ratio = stats.get_power_ratio()
+            if ('analogue_gain' in self.registers) and \
+                    self._outside('power_ratio', 'power_ratio', ratio, stats.get_power_ratio_error()):
+                # move whichever channel keeps the mean gain closest to 0 dB
+                gain_sum = iadc.registers['analogue_gain_vi'] + iadc.registers['analogue_gain_vq']
+                if ratio > 0:
+                    done = iadc.analogue_gain_dec('I') if gain_sum > 0 else iadc.analogue_gain_inc('Q')
+                else:
+                    done = iadc.analogue_gain_inc('I') if gain_sum < 0 else iadc.analogue_gain_dec('Q')
+                if done:
+                    self._trims['analogue_gain'].inc()
+                    trimmed['power_ratio'] = ratio
+            if 'fisda' in self.registers:
+                phase = stats.get_phase_difference()
+                fisda_phase = 2 * np.pi * stats.get_tone_frequency() * FISDA_STEP * 1e-12
+                if self._outside('phase', 'phase', phase, stats.get_phase_error(), fisda_phase):
+                    # FiSDA delays Q, which reduces a positive phase difference
+                    if (iadc.fisda_inc() if phase > 0 else iadc.fisda_dec()):
+                        self._trims['fisda'].inc()
+                        trimmed['phase'] = phase
+        if trimmed:
+            self.logger.info("ZDOK {z} drifted: {t}".format(z = self.cal.zdok_n, t = trimmed))
+        return trimmed
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Calibrates the ADCs of many ROACH boards at once.
+
+Each board is calibrated by one worker process of a bounded pool, which
+holds a single client to the board throughout. Within a board the ZDOKs are
+calibrated concurrently as in run_calibration. Register files are kept per
+board and a summary of all boards is written at the end:
+
+    ./fleet_calibration.py roach1 roach2 roach3 --workers 2 --routines offset phase
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+import concurrent_calibration
+from directionFinder_backend.correlator import Correlator
+
+ZDOKS = (0, 1)
+
+ROUTINES = {
+    'offset': lambda cal: cal.run_offset_cal(),
+    'offset_model': lambda cal: cal.run_offset_cal_model(),
+    'phase': lambda cal: cal.run_phase_difference_cal(),
+    'gain': lambda cal: cal.run_analogue_gain_cal(),
+}
+
+def calibrate_board(host, routine_names, directory, zdoks=ZDOKS):
+    """ Calibrates every ZDOK of the board at host with the routines in order,
+    starting from and saving to the register and offset slope files in
+    directory/host.
+    Runs in a worker process so only returns plain data.
+
+    Returns a dict with the host, the register file of each ZDOK, the time
+    taken by each routine and overall, the SPI writes issued per ZDOK, and
+    the error if calibration failed
+    """
+    logger = logging.getLogger(host)
+    board_directory = os.path.join(directory, host)
+    if not os.path.isdir(board_directory):
+        os.makedirs(board_directory)
+    register_files = dict((zdok_n, os.path.join(board_directory, 'registers_{z}.json'.format(z = zdok_n)))
+                          for zdok_n in zdoks)
+    slope_files = dict((zdok_n, os.path.join(board_directory, 'offset_slopes_{z}.json'.format(z = zdok_n)))
+                       for zdok_n in zdoks)
+    result = {'host': host, 'register_files': register_files, 'routine_times': {},
+              'spi_writes': {}, 'error': None}
+    start = time.time()
+    try:
+        correlator = Correlator(ip_addr = host, logger = logger.getChild('correlator'))
+        correlator.fetch_time_domain_snapshot(force=True)
+        calibrators = concurrent_calibration.build_calibrators(
+            correlator, zdoks, mode = 'indep', settle_mode = 'adaptive',
+            settle_filename = os.path.join(board_directory, 'settle_times_{zdok_n}.json'), logger = logger)
+        for cal in calibrators:
+            if os.path.exists(register_files[cal.zdok_n]):
+                cal.iadc.registers.get_from_file(register_files[cal.zdok_n])
+            cal.get_offset_slopes_from_file(slope_files[cal.zdok_n])
+            cal.iadc.write_all_registers()
+            cal.iadc.set_cal_mode('no_cal')
+        time.sleep(0.5)
+        for name in routine_names:
+            routine_start = time.time()
+            concurrent_calibration.run_concurrently(calibrators, ROUTINES[name])
+            result['routine_times'][name] = time.time() - routine_start
+        for cal in calibrators:
+            cal.iadc.registers.save_to_file(register_files[cal.zdok_n])
+            cal.save_offset_slopes(slope_files[cal.zdok_n])
+            result['spi_writes'][cal.zdok_n] = cal.iadc.spi_writes_issued
+    except Exception as e:
+        logger.exception("Calibration of {h} failed".format(h = host))
+        result['error'] = '{t}: {e}'.format(t = type(e).__name__, e = e)
+    result['duration'] = time.time() - start
+    return result
+
+def _calibrate_board(args):
+    # Pool#imap_unordered passes a single argument
+    return calibrate_board(*args)
+
+def calibrate_fleet(hosts, routine_names, directory, workers, logger=logging.getLogger(__name__)):
+    """ Calibrates every board in hosts with at most workers at a time.
+    Returns the summary: a dict with the results of #calibrate_board by host,
+    the number of workers and the total time taken
+    """
+    start = time.time()
+    results = {}
+    pool = multiprocessing.Pool(processes = min(workers, len(hosts)))
+    try:
+        tasks = [(host, routine_names, directory) for host in hosts]
+        for result in pool.imap_unordered(_calibrate_board, tasks):
+            results[result['host']] = result
+            logger.info("{h}: {s} in {t:.1f} s".format(
+                h = result['host'], s = result['error'] or 'calibrated', t = result['duration']))
+    finally:
+        pool.close()
+        pool.join()
+    return {'boards': results, 'workers': workers, 'duration': time.time() - start}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Calibrate the ADCs of many ROACH boards")
+    parser.add_argument('hosts', nargs='*', help="hostnames or IP addresses of the boards")
+    parser.add_argument('--hosts-file', help="file with one host per line, in addition to hosts")
+    parser.add_argument('--workers', type=int, default=4, help="boards calibrated at once")
+    parser.add_argument('--routines', nargs='+', default=['offset'], choices=sorted(ROUTINES))
+    parser.add_argument('--directory', default='fleet', help="register files are kept in a subdirectory per host")
+    parser.add_argument('--summary', default='fleet_summary.json', help="file to write the summary to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s:%(name)s:%(message)s")
+    logger = logging.getLogger('fleet')
+    hosts = list(args.hosts)
+    if args.hosts_file:
+        with open(args.hosts_file) as f:
+            hosts.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    if not hosts:
+        parser.error("no hosts given")
+    summary = calibrate_fleet(hosts, args.routines, args.directory, args.workers, logger)
+    with open(args.summary, 'w') as f:
+        f.write(json.dumps(summary, sort_keys=True, indent=4))
+    failures = [host for host, result in summary['boards'].items() if result['error'] is not None]
+    logger.info("Calibrated {n} boards with {w} workers in {t:.1f} s. {f} failed: {h}".format(
+        n = len(hosts), w = args.workers, t = summary['duration'], f = len(failures), h = ' '.join(failures)))
@@ -4,14 +4,24 @@ SNAPBLOCK_TYPE = 'bram' # bram or dram
 #SNAPBLOCK_TYPE = 'dram' # bram or dram
 SNAPBLOCK_LENGTH = 8*2**19 # only relevant for DRAM. The BRAM length is ascertained from fabric.
 
-import struct
 import time
+import numpy as np
 
 def get_snap():
+  """ Returns the snapshot as an np.int8 array which is a view on the buffer
+  read from the FPGA rather than a copy.
+  """
   roach.snapshot_arm(SNAPBLOCK_NAME, man_trig=True, man_valid=True, offset=-1, circular_capture=False)
   if SNAPBLOCK_TYPE == 'bram':
     adc_data = roach.snapshot_get(SNAPBLOCK_NAME, wait_period=-1, arm=False)["data"]
   else:
     time.sleep(0.1)
     adc_data = roach.read_dram(SNAPBLOCK_LENGTH)
-  return  struct.unpack(str(len(adc_data) ) + "b", (adc_data))
+  return np.frombuffer(adc_data, dtype=np.int8)
+
+def split_channels(samples, num_channels=2):
+  """ De-interleaves samples into a list of num_channels arrays. These are
+  strided views on samples so no data is copied.
+  """
+  samples = np.asarray(samples)
+  return [samples[chan::num_channels] for chan in range(num_channels)]
@@ -0,0 +1,84 @@
+"""
+A binary log of every iteration of the calibration routines, for drift
+analysis across many runs and boards.
+
+The file is a RecordFile of RECORD_DTYPE records. Records are only ever
+appended, so #load can memory map the whole file into a NumPy structured
+array without parsing it:
+
+    history = history_log.load('history.bin')
+    zdok0 = history[history['zdok'] == 0]
+    plot(zdok0['offset_vi'], zdok0['mean_I'])
+"""
+
+import logging
+import time
+import numpy as np
+from record_file import RecordFile
+
+MAGIC = b'IADCHIST'
+VERSION = 1  # the header holds the record size
+
+REGISTERS = ('offset_vi', 'offset_vq', 'analogue_gain_vi', 'analogue_gain_vq',
+             'gain_compensation_vi', 'gain_compensation_vq', 'fisda_q',
+             'drda_vi', 'drda_vq', 'isa_i', 'isa_q')
+
+RECORD_DTYPE = np.dtype(
+    [('timestamp', '<f8'),  # seconds since the epoch
+     ('zdok', '<u1'),
+     ('register', 'S24'),  # which register was written in this iteration
+     ('control', '<u2')] +
+    [(name, '<f4') for name in REGISTERS] +
+    [('mean_I', '<f4'), ('mean_Q', '<f4'),  # LSB
+     ('power_I', '<f4'), ('power_Q', '<f4'),  # LSB^2
+     ('phase', '<f4')])  # radians. NaN unless the phase was being calibrated
+
+class HistoryLog(object):
+    def __init__(self, filename, logger=logging.getLogger(__name__)):
+        """ Opens filename for appending, creating it if needed. Several
+        Calibrators may share one HistoryLog.
+        """
+        self.logger = logger
+        self.filename = filename
+        self._file = _record_file(filename)
+        if not self._file.exists():
+            self._file.create(RECORD_DTYPE.itemsize)
+        else:
+            _check_header(self._file)
+
+    def append(self, zdok_n, register, registers, mean, power, phase=float('nan')):
+        """ Appends a record
+
+        register -- name of the register which was just written
+        registers -- IAdcRegisters after the write
+        mean, power -- dicts mapping 'I' and 'Q' to their values
+        phase -- phase difference between I and Q
+        """
+        record = np.zeros(1, dtype=RECORD_DTYPE)
+        record['timestamp'] = time.time()
+        record['zdok'] = zdok_n
+        record['register'] = register.encode('ascii')
+        record['control'] = registers['control'].value
+        for name in REGISTERS:
+            record[name] = registers[name]
+        for channel in ('I', 'Q'):
+            record['mean_' + channel] = mean[channel]
+            record['power_' + channel] = power[channel]
+        record['phase'] = phase
+        self._file.append(record)
+
+def _record_file(filename):
+    return RecordFile(filename, MAGIC, VERSION, 'calibration history log')
+
+def _check_header(record_file):
+    if record_file.read_header() != RECORD_DTYPE.itemsize:
+        raise ValueError("{f} is not a version {v} calibration history log".format(
+            f = record_file.filename, v = VERSION))
+
+def load(filename):
+    """ Returns the records in filename as a read only, memory mapped
+    structured array of RECORD_DTYPE. A partly written last record is ignored.
+    """
+    record_file = _record_file(filename)
+    _check_header(record_file)
+    return record_file.load(RECORD_DTYPE)
@@ -7,7 +7,10 @@
 import corr
 import logging
 import json
+import contextlib
 from iadc_registers import IAdcRegisters
+import iadc_register_map
+import metrics
 
 class IAdc:
     def __init__(self, fpga, zdok_n, mode='indep', logger=logging.getLogger(__name__)):
@@ -23,6 +26,16 @@ class IAdc:
         self.fpga = fpga
         corr.iadc.set_mode(self.fpga, mode='SPI')  # enable software control
         self.registers = IAdcRegisters()
+        self._shadow = {}  # SPI address -> last word written to the hardware
+        self._pending = set()  # SPI addresses modified during a transaction
+        self._transaction_depth = 0
+        self._staged_from = None  # register values when the outermost transaction started
+        self.spi_writes_issued = 0
+        self.spi_writes_skipped = 0
+        self._spi_write_timer = metrics.REGISTRY.timer(
+            'iadc_spi_write_seconds', "Time taken by each SPI register write", zdok=zdok_n)
+        self._spi_skipped_counter = metrics.REGISTRY.counter(
+            'iadc_spi_writes_skipped_total', "SPI register writes skipped as unchanged", zdok=zdok_n)
         self.write_control_reg()
         self.logger.debug("Initialised iADC for software control")
 
@@ -32,27 +45,100 @@ class IAdc:
         """
         return self.fpga.read('iadc_controller', 128)
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Defers register writes until the end of the with block. Writes to
+        fields which share an SPI address are coalesced into one write and
+        addresses whose word has not changed since it was last written are
+        skipped. Transactions may be nested; the outermost one commits.
+        If the with block raises nothing is written and the registers are
+        put back to their values from before the outermost transaction.
+
+        with iadc.transaction():
+            iadc.offset_set('I', 1.25)
+            iadc.offset_set('Q', -0.5)
+        """
+        if self._transaction_depth == 0:
+            self._staged_from = self.registers.to_dict()
+        self._transaction_depth += 1
+        try:
+            yield
+        except:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.registers.from_dict(self._staged_from)
+                self._pending.clear()
+            raise
+        self._transaction_depth -= 1
+        if self._transaction_depth == 0:
+            self.commit()
+
+    def commit(self):
+        """
+        Writes every pending SPI address whose encoded word differs from what
+        was last written to the hardware.
+        """
+        for address in sorted(self._pending):
+            word = iadc_register_map.encode(address, self.registers)
+            if self._shadow.get(address) == word:
+                self.spi_writes_skipped += 1
+                self._spi_skipped_counter.inc()
+                continue
+            with self._spi_write_timer.time():
+                corr.iadc.spi_write_register(self.fpga, self.zdok_n, address, word)
+            self._shadow[address] = word
+            self.spi_writes_issued += 1
+            self.logger.debug("SPI address {a:#04x} set to: {w:#06x}".format(a = address, w = word))
+        self._pending.clear()
+
+    def invalidate_shadow(self):
+        """
+        Forgets what was written to the hardware so that the next write to
+        each address is not skipped. Needed if the iADC may have lost its state.
+        """
+        self._shadow = {}
+
+    def _write(self, *names):
+        """
+        Marks the SPI addresses holding registers names as modified. They are
+        written immediately unless there's a transaction in progress.
+        """
+        for name in names:
+            self._pending.add(iadc_register_map.address_of(name))
+        if self._transaction_depth == 0:
+            self.commit()
+
     def write_control_reg(self):
-        corr.iadc.spi_write_register(self.fpga, self.zdok_n, 0x00, self.registers['control'].value)
+        self._write('control')
         self.logger.debug("Control register set to: {cr:#06x}".format(cr = self.registers['control'].value))
 
     def reset_dcm(self):
         corr.iadc.rst(self.fpga, self.zdok_n)
+        self.invalidate_shadow()  # the reset may have lost the register values
         self.logger.info("iADC DCM reset for ZDOKL {n}".format(n = self.zdok_n))
 
-    def write_all_registers(self):
-        self.write_control_reg()
-        self.offset_set('I', self.registers['offset_vi'])
-        self.offset_set('Q', self.registers['offset_vq'])
-        self.analogue_gain_set('I', self.registers['analogue_gain_vi'])
-        self.analogue_gain_set('Q', self.registers['analogue_gain_vq'])
-        self.gain_compensation_set('I', self.registers['gain_compensation_vi'])
-        self.gain_compensation_set('Q', self.registers['gain_compensation_vq'])
-        self.drda_set('I', self.registers['drda_vi'])
-        self.drda_set('Q', self.registers['drda_vq'])
-        self.fisda_set(self.registers['fisda_q'])
-        self.isa_set('I', self.registers['isa_i'])
-        self.isa_set('Q', self.registers['isa_q'])
+    def write_all_registers(self, force=False):
+        """
+        Writes all registers to the hardware in a single transaction.
+
+        force -- if True, also writes addresses which are believed to be
+            unchanged on the hardware.
+        """
+        if force:
+            self.invalidate_shadow()
+        with self.transaction():
+            self.write_control_reg()
+            self.offset_set_iq(self.registers['offset_vi'], self.registers['offset_vq'])
+            self.analogue_gain_set('I', self.registers['analogue_gain_vi'])
+            self.analogue_gain_set('Q', self.registers['analogue_gain_vq'])
+            self.gain_compensation_set('I', self.registers['gain_compensation_vi'])
+            self.gain_compensation_set('Q', self.registers['gain_compensation_vq'])
+            self.drda_set('I', self.registers['drda_vi'])
+            self.drda_set('Q', self.registers['drda_vq'])
+            self.fisda_set(self.registers['fisda_q'])
+            self.isa_set('I', self.registers['isa_i'])
+            self.isa_set('Q', self.registers['isa_q'])
 
     def set_cal_mode(self, mode):
         """
@@ -111,8 +197,7 @@ class IAdc:
             self.registers['offset_vi'] += 0.25
         elif channel == 'Q':
             self.registers['offset_vq'] += 0.25
-        corr.iadc.offset_adj(self.fpga, self.zdok_n, self.registers['offset_vi'], self.registers['offset_vq'])
-        # this reall should be moved into the corr.iadc file...
+        self._write('offset_vi', 'offset_vq')
         self.logger.info("For ADC {z}, offset for I: {vi}, offset for Q: {vq}".format(
             z = self.zdok_n, vi = self.registers['offset_vi'], vq = self.registers['offset_vq']))
         return True
@@ -133,7 +218,7 @@ class IAdc:
             self.registers['offset_vi'] -= 0.25
         elif channel == 'Q':
             self.registers['offset_vq'] -= 0.25
-        corr.iadc.offset_adj(self.fpga, self.zdok_n, self.registers['offset_vi'], self.registers['offset_vq'])
+        self._write('offset_vi', 'offset_vq')
         self.logger.info("For ADC {z}, offset for I: {vi}, offset for Q: {vq}".format(
             z = self.zdok_n, vi = self.registers['offset_vi'], vq = self.registers['offset_vq']))
         return True
@@ -152,31 +237,47 @@ class IAdc:
             self.registers['offset_vi'] = value
         if channel == 'Q':
             self.registers['offset_vq'] = value
-        corr.iadc.offset_adj(self.fpga, self.zdok_n, self.registers['offset_vi'], self.registers['offset_vq'])
+        self._write('offset_vi', 'offset_vq')
+        self.logger.info("For ADC {z}, offset for I: {vi}, offset for Q: {vq}".format(
+            z = self.zdok_n, vi = self.registers['offset_vi'], vq = self.registers['offset_vq']))
+
+    def offset_set_iq(self, value_i, value_q):
+        """
+        Sets the offset for both channels in a single register write.
+
+        value_i, value_q -- Values in LSB from -31.75 to 31.75
+        """
+        assert( (value_i <= 31.75) and (value_i >= -31.75) )
+        assert( (value_q <= 31.75) and (value_q >= -31.75) )
+        self.registers['offset_vi'] = value_i
+        self.registers['offset_vq'] = value_q
+        self._write('offset_vi', 'offset_vq')
         self.logger.info("For ADC {z}, offset for I: {vi}, offset for Q: {vq}".format(
             z = self.zdok_n, vi = self.registers['offset_vi'], vq = self.registers['offset_vq']))
 
     def analogue_gain_inc(self, channel):
         """
-        Increments analogue gain for channel by 0.011 dB
+        Increments analogue gain for channel by one code of 1.5/127 dB
         Returns True of gain can be adjusted or False if alreadt at maximum
         """
         assert(channel in ('I', 'Q'))
+        step = iadc_register_map.ANALOGUE_GAIN_STEP
         if channel == 'I':
-            return self.analogue_gain_set(channel, self.registers['analogue_gain_vi'] + 0.011)
+            return self.analogue_gain_set(channel, self.registers['analogue_gain_vi'] + step)
         elif channel == 'Q':
-            return self.analogue_gain_set(channel, self.registers['analogue_gain_vq'] + 0.011)
+            return self.analogue_gain_set(channel, self.registers['analogue_gain_vq'] + step)
 
     def analogue_gain_dec(self, channel):
         """
-        Decreases analogue gain for channel by 0.011 dB.
+        Decreases analogue gain for channel by one code of 1.5/127 dB.
         Returns True if gain can by decreased or False if already at minimum
         """
         assert(channel in ('I', 'Q'))
+        step = iadc_register_map.ANALOGUE_GAIN_STEP
         if channel == 'I':
-            return self.analogue_gain_set(channel, self.registers['analogue_gain_vi'] - 0.011)
+            return self.analogue_gain_set(channel, self.registers['analogue_gain_vi'] - step)
         elif channel == 'Q':
-            return self.analogue_gain_set(channel, self.registers['analogue_gain_vq'] - 0.011)
+            return self.analogue_gain_set(channel, self.registers['analogue_gain_vq'] - step)
 
     def analogue_gain_set(self, channel, value):
         """
@@ -190,20 +291,42 @@ class IAdc:
             self.registers['analogue_gain_vi'] = value
         if channel == 'Q':
             self.registers['analogue_gain_vq'] = value
-        corr.iadc.analogue_gain_adj(
-            self.fpga, self.zdok_n, self.registers['analogue_gain_vi'], self.registers['analogue_gain_vq']) 
+        self._write('analogue_gain_vi', 'analogue_gain_vq')
         self.logger.info("For ADC {z}, analogue gain for I: {vi}, anaogue gain for Q: {vq}".format(
             z = self.zdok_n, vi = self.registers['analogue_gain_vi'], vq = self.registers['analogue_gain_vq']))
         return True
 
     def gain_compensation_inc(self, channel):
-        pass
+        """
+        Increments the gain compensation by 0.005 dB
+        Returns True if it can be incremented or False if already at maximum
+        """
+        return self.gain_compensation_set(channel, self.registers['gain_compensation_vq'] + 0.005)
 
     def gain_compensation_dec(self, channel):
-        pass
+        """
+        Decrements the gain compensation by 0.005 dB
+        Returns True if it can be decremented or False if already at minimum
+        """
+        return self.gain_compensation_set(channel, self.registers['gain_compensation_vq'] - 0.005)
 
     def gain_compensation_set(self, channel, value):
-        pass
+        """
+        Sets the gain compensation, used to match the gain of the Q core to the
+        I core when interleaving, to a value between -0.315 dB and 0.315 dB.
+        The iADC has a single gain compensation for both cores so both
+        registers hold the same value whichever channel is given.
+        Returns True if the value is valid or False if it is out of bounds
+        """
+        assert(channel in ('I', 'Q'))
+        if( (value > 0.315 + 1e-9) or (value < -0.315 - 1e-9) ):  # check for out of bounds
+            self.logger.warn("Gain compensation of {v} outside of [-0.315; 0.315] bounds".format(v = value))
+            return False
+        self.registers['gain_compensation_vi'] = value
+        self.registers['gain_compensation_vq'] = value
+        self._write('gain_compensation_vi', 'gain_compensation_vq')
+        self.logger.info("For ADC {z}, gain compensation set to {v} dB".format(z = self.zdok_n, v = value))
+        return True
 
     def fisda_set(self, value):
         """
@@ -215,7 +338,7 @@ class IAdc:
             self.logger.warn("FiSDA value of {v} outside of [-60; 60] bounds".format(v = value))
             return False
         self.registers['fisda_q'] = value
-        corr.iadc.fisda_Q_adj(self.fpga, self.zdok_n, self.registers['fisda_q'])
+        self._write('fisda_q')
         self.logger.info("For ADC {z}, FiSDA set to {v} ps".format(
             z = self.zdok_n, v = self.registers['fisda_q']))
         return True
@@ -248,7 +371,7 @@ class IAdc:
             self.registers['isa_i'] = value
         if channel == 'Q':
             self.registers['isa_q'] = value
-        corr.iadc.isa_adj(self.fpga, self.zdok_n, self.registers['isa_i'], self.registers['isa_q'])
+        self._write('isa_i', 'isa_q')
         self.logger.info("For ADC {z}, ISA_I: {i}, ISA_Q: {q}".format(
             z = self.zdok_n, i = self.registers['isa_i'], q = self.registers['isa_q']))
         
@@ -0,0 +1,206 @@
+"""
+Encodes the values held in IAdcRegisters into the 16 bit words written to
+each SPI address of the iADC, and decodes them again.
+
+The words are the same as those written by the adjustment functions of
+corr.iadc, which are what this code used before, except that values are
+rounded to the nearest code rather than truncated. See #check_against_corr.
+Each address holds one or more of the named registers:
+    0x00 control: see IAdcRegistersControl
+    0x01 analogue gain: D7-D0 channel I, D15-D8 channel Q. Sign-magnitude
+        with the sign in the top bit set for negative gains. 127 steps of
+        1.5/127 dB up to 1.5 dB. As corr.iadc#analogue_gain_adj
+    0x02 offset: D7-D0 channel I, D15-D8 channel Q. Sign-magnitude with
+        the sign in the top bit set for positive offsets. Steps of 0.25 LSB,
+        up to 31.75 LSB. As corr.iadc#offset_adj
+    0x03 gain compensation: D6-D0, sign-magnitude with the sign in D6 set
+        for negative values. Steps of 0.005 dB, up to 0.315 dB. Q is matched
+        to I. As corr.iadc#gain_adj
+    0x04 ISA: D2-D0 channel I, D5-D3 channel Q. code 0 = -200 ps, steps
+        of 50 ps. D15-D6 are fixed at 1000 0100 00. corr.iadc has no
+        equivalent so this follows the datasheet.
+    0x07 FiSDA/DRDA: D10-D6 FiSDA on Q, sign-magnitude with the sign in D10
+        set for negative delays. Steps of 4 ps, up to 60 ps. As
+        corr.iadc#fisda_Q_adj. D5-D3 DRDA Q, D2-D0 DRDA I, as codes. corr
+        leaves these at 0.
+"""
+
+import os
+import numpy as np
+from iadc_registers_control import IAdcRegistersControl
+
+ANALOGUE_GAIN_MAX = 1.5  # dB
+ANALOGUE_GAIN_MAX_CODE = 127
+ANALOGUE_GAIN_STEP = ANALOGUE_GAIN_MAX / ANALOGUE_GAIN_MAX_CODE  # dB, one code
+OFFSET_STEP = 0.25  # LSB
+OFFSET_MAX = 31.75  # LSB
+OFFSET_MAX_CODE = 127
+GAIN_COMPENSATION_STEP = 0.005  # dB
+GAIN_COMPENSATION_MAX = 0.315  # dB
+GAIN_COMPENSATION_MAX_CODE = 63
+ISA_STEP = 50  # ps
+ISA_MIN = -200  # ps
+FISDA_STEP = 4  # ps
+FISDA_MAX = 60  # ps
+FISDA_MAX_CODE = 15
+ISA_FIXED_BITS = 0x8400
+
+# SPI address -> names of the registers it holds
+FIELDS = {
+    0x00: ('control',),
+    0x01: ('analogue_gain_vi', 'analogue_gain_vq'),
+    0x02: ('offset_vi', 'offset_vq'),
+    0x03: ('gain_compensation_vi', 'gain_compensation_vq'),
+    0x04: ('isa_i', 'isa_q'),
+    0x07: ('fisda_q', 'drda_vi', 'drda_vq'),
+}
+
+ADDRESSES = dict((name, address) for address, names in FIELDS.items() for name in names)
+
+def _to_sign_magnitude(value, full_scale, max_code, sign_bit, negative=True):
+    """ Returns the sign-magnitude code of value, rounded to the nearest code
+    so that values on the grid survive a round trip through #decode.
+    corr.iadc truncates instead, which gives the same codes apart from where
+    floating point error puts a value on the grid just below its code.
+    The sign bit is set for negative values, or for positive ones if
+    negative is False.
+    """
+    magnitude = min(int(round(abs(value) * max_code / float(full_scale))), max_code)
+    if ((value < 0) if negative else (value > 0)) and (magnitude != 0):
+        return magnitude | (1 << sign_bit)
+    return magnitude
+
+def _from_sign_magnitude(code, full_scale, max_code, sign_bit, negative=True):
+    magnitude = (code & ((1 << sign_bit) - 1)) * full_scale / float(max_code)
+    if (magnitude != 0) and (bool(code & (1 << sign_bit)) == negative):
+        return -magnitude
+    return magnitude
+
+def _analogue_gain_code(value):
+    return _to_sign_magnitude(value, ANALOGUE_GAIN_MAX, ANALOGUE_GAIN_MAX_CODE, 7)
+
+def _offset_code(value):
+    return _to_sign_magnitude(value, OFFSET_MAX, OFFSET_MAX_CODE, 7, negative=False)
+
+def _isa_code(value):
+    return min(max(int(round((value - ISA_MIN) / float(ISA_STEP))), 0), 0b111)
+
+def _drda_code(value):
+    return min(max(int(round(value)), 0), 0b111)
+
+def address_of(name):
+    """ Returns the SPI address holding the register called name
+    """
+    return ADDRESSES[name]
+
+def encode(address, registers):
+    """ Returns the 16 bit word for address given the values in registers,
+    an instance of IAdcRegisters (or anything indexable by register name)
+    """
+    if address == 0x00:
+        return registers['control'].value
+    if address == 0x01:
+        return (_analogue_gain_code(registers['analogue_gain_vq']) << 8) | \
+            _analogue_gain_code(registers['analogue_gain_vi'])
+    if address == 0x02:
+        return (_offset_code(registers['offset_vq']) << 8) | _offset_code(registers['offset_vi'])
+    if address == 0x03:
+        # a single value for both cores
+        return _to_sign_magnitude(registers['gain_compensation_vq'], GAIN_COMPENSATION_MAX,
+                                  GAIN_COMPENSATION_MAX_CODE, 6)
+    if address == 0x04:
+        return ISA_FIXED_BITS | (_isa_code(registers['isa_q']) << 3) | _isa_code(registers['isa_i'])
+    if address == 0x07:
+        return (_to_sign_magnitude(registers['fisda_q'], FISDA_MAX, FISDA_MAX_CODE, 4) << 6) | \
+            (_drda_code(registers['drda_vq']) << 3) | _drda_code(registers['drda_vi'])
+    raise ValueError("No registers at SPI address {a:#04x}".format(a = address))
+
+def encode_all(registers):
+    """ Returns a dict mapping every SPI address to its word
+    """
+    return dict((address, encode(address, registers)) for address in FIELDS)
+
+def decode(address, word):
+    """ Returns a dict mapping the names of the registers at address to
+    their values as held in IAdcRegisters
+    """
+    if address == 0x00:
+        control = IAdcRegistersControl()
+        control.value = word
+        return {'control': control}
+    if address == 0x01:
+        return {'analogue_gain_vi': _from_sign_magnitude(word & 0xff, ANALOGUE_GAIN_MAX, ANALOGUE_GAIN_MAX_CODE, 7),
+                'analogue_gain_vq': _from_sign_magnitude(word >> 8, ANALOGUE_GAIN_MAX, ANALOGUE_GAIN_MAX_CODE, 7)}
+    if address == 0x02:
+        return {'offset_vi': _from_sign_magnitude(word & 0xff, OFFSET_MAX, OFFSET_MAX_CODE, 7, negative=False),
+                'offset_vq': _from_sign_magnitude(word >> 8, OFFSET_MAX, OFFSET_MAX_CODE, 7, negative=False)}
+    if address == 0x03:
+        value = _from_sign_magnitude(word & 0x7f, GAIN_COMPENSATION_MAX, GAIN_COMPENSATION_MAX_CODE, 6)
+        return {'gain_compensation_vi': value, 'gain_compensation_vq': value}
+    if address == 0x04:
+        return {'isa_i': ISA_MIN + ((word & 0b111) * ISA_STEP),
+                'isa_q': ISA_MIN + (((word >> 3) & 0b111) * ISA_STEP)}
+    if address == 0x07:
+        return {'fisda_q': _from_sign_magnitude((word >> 6) & 0x1f, FISDA_MAX, FISDA_MAX_CODE, 4),
+                'drda_vq': (word >> 3) & 0b111,
+                'drda_vi': word & 0b111}
+    raise ValueError("No registers at SPI address {a:#04x}".format(a = address))
+
+class _RecordingFpga(object):
+    """ Stands in for an FpgaClient, keeping the word written to each SPI address
+    """
+    def __init__(self):
+        self.words = {}
+
+    def blindwrite(self, device_name, data, offset=0):
+        data = bytearray(data)
+        if (device_name == 'iadc_controller') and (offset >= 0x4):
+            self.words[data[2]] = (data[0] << 8) | data[1]
+
+def check_against_corr(corr_iadc):
+    """ Checks that #encode gives the same words as the adjustment functions of
+    corr.iadc for every code they can write, other than the end codes.
+
+    corr_iadc -- the corr.iadc module
+    Returns a list of (address, registers, expected word, encoded word) for
+    every mismatch. Empty if they all agree.
+    """
+    import sys
+    from iadc_registers import IAdcRegisters
+    fpga = _RecordingFpga()
+    # fisda_Q_adj names its argument zdock_n but uses zdok_n
+    corr_iadc.zdok_n = 0
+    cases = []
+    # corr truncates, so some values on the grid come out a code low. A
+    # quarter of a code further from 0 gives the intended code, which it
+    # can't do for the end codes.
+    nudge = lambda code, step: (code + 0.25 * np.sign(code)) * step
+    step = ANALOGUE_GAIN_STEP
+    for code in range(-ANALOGUE_GAIN_MAX_CODE + 1, ANALOGUE_GAIN_MAX_CODE):
+        cases.append((0x01, {'analogue_gain_vi': code * step, 'analogue_gain_vq': -code * step},
+                      lambda c=code: corr_iadc.analogue_gain_adj(fpga, 0, nudge(c, step), nudge(-c, step))))
+    for code in range(-OFFSET_MAX_CODE + 1, OFFSET_MAX_CODE):
+        cases.append((0x02, {'offset_vi': code * OFFSET_STEP, 'offset_vq': -(code // 2) * OFFSET_STEP},
+                      lambda c=code: corr_iadc.offset_adj(fpga, 0, nudge(c, OFFSET_STEP), nudge(-(c // 2), OFFSET_STEP))))
+    for code in range(-GAIN_COMPENSATION_MAX_CODE + 1, GAIN_COMPENSATION_MAX_CODE):
+        cases.append((0x03, {'gain_compensation_vi': code * GAIN_COMPENSATION_STEP,
+                             'gain_compensation_vq': code * GAIN_COMPENSATION_STEP},
+                      lambda c=code: corr_iadc.gain_adj(fpga, 0, nudge(c, GAIN_COMPENSATION_STEP))))
+    for code in range(-FISDA_MAX_CODE + 1, FISDA_MAX_CODE):
+        cases.append((0x07, {'fisda_q': code * FISDA_STEP},
+                      lambda c=code: corr_iadc.fisda_Q_adj(fpga, 0, nudge(c, FISDA_STEP))))
+    mismatches = []
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # corr prints every word it writes
+    try:
+        for address, values, write in cases:
+            registers = IAdcRegisters()
+            for name, value in values.items():
+                registers[name] = value
+            write()
+            if fpga.words[address] != encode(address, registers):
+                mismatches.append((address, values, fpga.words[address], encode(address, registers)))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return mismatches
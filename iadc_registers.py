@@ -2,8 +2,79 @@
 
 import json
 import logging
+import struct
+import zlib
 from iadc_registers_control import IAdcRegistersControl
-import os, copy
+import iadc_register_map
+import os
+
+IMAGE_MAGIC = b'IADCREGS'
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct('<8sHH')  # magic, version, number of addresses
+IMAGE_WORD = struct.Struct('<BH')  # address, word
+IMAGE_CHECKSUM = struct.Struct('<I')  # CRC32 of everything before it
+
+class RegisterImage(object):
+    """ An immutable snapshot of the registers as the 16 bit word written to
+    each SPI address. Register values can be read from it by name as from
+    IAdcRegisters.
+    """
+    __slots__ = ('_words',)
+
+    def __init__(self, words):
+        """ words -- dict mapping SPI address to word, as from iadc_register_map#encode_all
+        """
+        object.__setattr__(self, '_words', tuple(sorted(words.items())))
+
+    def __setattr__(self, name, value):
+        raise TypeError("RegisterImage is immutable")
+
+    def words(self):
+        """ Returns a dict mapping SPI address to word
+        """
+        return dict(self._words)
+
+    def __getitem__(self, name):
+        return iadc_register_map.decode(iadc_register_map.address_of(name), dict(self._words)[
+            iadc_register_map.address_of(name)])[name]
+
+    def __eq__(self, other):
+        return isinstance(other, RegisterImage) and (self._words == other._words)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(self._words)
+
+    def to_bytes(self):
+        """ Returns the packed binary form: a header, an address and word for
+        each address, and a CRC32 checksum
+        """
+        data = IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, len(self._words))
+        data += b''.join(IMAGE_WORD.pack(address, word) for address, word in self._words)
+        return data + IMAGE_CHECKSUM.pack(zlib.crc32(data) & 0xffffffff)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Returns the RegisterImage packed by #to_bytes. Raises ValueError
+        if data is corrupt.
+        """
+        data = bytes(data)
+        if len(data) < IMAGE_HEADER.size + IMAGE_CHECKSUM.size:
+            raise ValueError("Register image too short")
+        body, (checksum,) = data[:-IMAGE_CHECKSUM.size], IMAGE_CHECKSUM.unpack(data[-IMAGE_CHECKSUM.size:])
+        if (zlib.crc32(body) & 0xffffffff) != checksum:
+            raise ValueError("Register image checksum mismatch")
+        magic, version, count = IMAGE_HEADER.unpack(body[:IMAGE_HEADER.size])
+        if (magic != IMAGE_MAGIC) or (version != IMAGE_VERSION) or \
+                (len(body) != IMAGE_HEADER.size + (count * IMAGE_WORD.size)):
+            raise ValueError("Not a version {v} register image".format(v = IMAGE_VERSION))
+        words = {}
+        for idx in range(count):
+            address, word = IMAGE_WORD.unpack_from(body, IMAGE_HEADER.size + (idx * IMAGE_WORD.size))
+            words[address] = word
+        return cls(words)
 
 class IAdcRegisters(object):
     """ Instances of this will look similar to a list where the items are the 
@@ -46,12 +117,18 @@ class IAdcRegisters(object):
         for name, value in self.default_values().items():
             self._registers[name] = value
 
-    def get_from_file(self, filename):
+    def to_dict(self):
+        """ Returns a dict mapping register names to their values, with the
+        control register as its integer value so that it can be serialised.
         """
-        Reads a JSON file which was written by #save_to_fil and sets the registers to those values
+        # all values other than the control register are immutable so a shallow copy will do
+        registers = dict(self._registers)
+        registers['control'] = registers['control'].value
+        return registers
+
+    def from_dict(self, registers):
+        """ Sets the registers to the values in a dict as returned by #to_dict
         """
-        with open(filename) as f:
-            registers = json.loads(f.read())
         for name, value in registers.items():
             self._registers[name] = value
         # special case: the control register should be an instance of IadcRegistersControl
@@ -59,14 +136,48 @@ class IAdcRegisters(object):
         control_reg.value = self._registers['control']
         self._registers['control'] = control_reg
 
+    def snapshot(self):
+        """ Returns a RegisterImage of the current values. This is much cheaper
+        than copying the registers and can be shared between threads.
+        """
+        return RegisterImage(iadc_register_map.encode_all(self))
+
+    def restore(self, image):
+        """ Sets the registers to the values in a RegisterImage. These are
+        the values the hardware holds, quantised to its codes, so a value
+        between two codes comes back as the nearer one.
+        """
+        for address, word in image.words().items():
+            for name, value in iadc_register_map.decode(address, word).items():
+                self._registers[name] = value
+
+    def get_from_binary_file(self, filename):
+        """ Reads a file written by #save_to_binary_file and sets the registers
+        to those values, quantised to the hardware codes as for #restore,
+        unlike #get_from_file. Raises ValueError if the file is corrupt.
+        """
+        with open(filename, 'rb') as f:
+            self.restore(RegisterImage.from_bytes(f.read()))
+
+    def save_to_binary_file(self, filename):
+        """ Writes the SPI word of every address to filename in the packed
+        format of RegisterImage#to_bytes
+        """
+        with open(filename, 'wb') as f:
+            f.write(self.snapshot().to_bytes())
+
+    def get_from_file(self, filename):
+        """
+        Reads a JSON file which was written by #save_to_fil and sets the registers to those values
+        """
+        with open(filename) as f:
+            self.from_dict(json.loads(f.read()))
+
     def save_to_file(self, filename):
         """
-        Writes all register names and values to filename in the JSON file format
-        In order to be thread safe we duplicate the registers attribute.
+        Writes all register names and values to filename in the JSON file format.
+        See #save_to_binary_file for a more compact format.
         """
-        # swap the control register object with just a value
-        registers_to_write = copy.deepcopy(self._registers)
-        registers_to_write['control'] = registers_to_write['control'].value
-        json_string = json.dumps(registers_to_write, sort_keys=True, indent=4)
+        json_string = json.dumps(self.to_dict(), sort_keys=True, indent=4)
         with open(filename, 'w') as f:
             f.write(json_string)
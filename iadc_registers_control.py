@@ -39,6 +39,13 @@ class IAdcRegistersControl:
         self.value &= ~(0b11 << 4)
         self.value |= (bits_map[mode] << 4)
 
+    def get_analogue_selection(self):
+        """
+        Returns the mode set by #set_analogue_selection
+        """
+        modes_map = {0b00: 'inter_Q', 0b10: 'inter_I', 0b11: 'indep'}
+        return modes_map[(self.value >> 4) & 0b11]
+
     def set_clock_selection(self, mode):
         """
         Specifies the phase between each core's clock
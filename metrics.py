@@ -0,0 +1,133 @@
+"""
+In-process counters and timers for the hot paths of the calibration.
+They can be dumped as JSON or in the Prometheus text format.
+
+Metrics are looked up once, outside the hot path, and then updated:
+
+    skipped = metrics.REGISTRY.counter('iadc_spi_writes_skipped_total', "SPI writes skipped", zdok=0)
+    skipped.inc()
+"""
+
+import json
+import threading
+import time
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def as_dict(self):
+        return {'value': self.value}
+
+class Timer(object):
+    kind = 'summary'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def time(self):
+        """ Returns a context manager which observes how long its block takes
+        """
+        return _Timing(self)
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max}
+
+class _Timing(object):
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timer.observe(time.time() - self.start)
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}  # (name, sorted label items) -> metric
+        self._help = {}  # name -> help text
+
+    def counter(self, name, description='', **labels):
+        """ Returns the counter called name with labels, creating it if needed
+        """
+        return self._get(Counter, name, description, labels)
+
+    def timer(self, name, description='', **labels):
+        """ Returns the timer called name with labels, creating it if needed.
+        Times are in seconds.
+        """
+        return self._get(Timer, name, description, labels)
+
+    def _get(self, kind, name, description, labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            if key not in self._metrics:
+                self._metrics[key] = kind()
+                self._help.setdefault(name, description)
+            metric = self._metrics[key]
+        if not isinstance(metric, kind):
+            raise TypeError("Metric {n} is not a {k}".format(n = name, k = kind.__name__))
+        return metric
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+            self._help = {}
+
+    def _items(self):
+        with self._lock:
+            return sorted(self._metrics.items())
+
+    def as_dict(self):
+        """ Returns a dict mapping each metric name to a list of dicts, one per
+        set of labels, with the labels and the metric's values.
+        """
+        result = {}
+        for (name, labels), metric in self._items():
+            entry = {'labels': dict(labels)}
+            entry.update(metric.as_dict())
+            result.setdefault(name, []).append(entry)
+        return result
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), sort_keys=True, indent=4)
+
+    def to_prometheus(self):
+        """ Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        last_name = None
+        for (name, labels), metric in self._items():
+            if name != last_name:
+                lines.append('# HELP {n} {h}'.format(n = name, h = self._help[name]))
+                lines.append('# TYPE {n} {k}'.format(n = name, k = metric.kind))
+                last_name = name
+            label_str = ','.join('{k}="{v}"'.format(k = k, v = v) for k, v in labels)
+            label_str = '{' + label_str + '}' if label_str else ''
+            if metric.kind == 'counter':
+                lines.append('{n}{l} {v}'.format(n = name, l = label_str, v = metric.value))
+            else:
+                lines.append('{n}_count{l} {v}'.format(n = name, l = label_str, v = metric.count))
+                lines.append('{n}_sum{l} {v!r}'.format(n = name, l = label_str, v = metric.total))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,71 @@
+"""
+Files of fixed size binary records which are only ever appended to, as
+used by history_log and capture_recorder.
+
+Each file is a short header followed by the records, each a NumPy
+structured array element. The header holds a magic string identifying the
+kind of file, its version and one value describing the records, such as
+their size. As records are never rewritten, #load can memory map the whole
+file without parsing it.
+"""
+
+import os
+import struct
+import threading
+import numpy as np
+
+HEADER = struct.Struct('<8sII')  # magic, version, value describing the records
+
+class RecordFile(object):
+    def __init__(self, filename, magic, version, description):
+        """
+        filename -- file holding the records
+        magic -- 8 byte string at the start of every file of this kind
+        version -- version of the record layout
+        description -- what the file is, for error messages. eg: 'capture file'
+        """
+        self.filename = filename
+        self.magic = magic
+        self.version = version
+        self.description = description
+        self._lock = threading.Lock()
+
+    def exists(self):
+        """ Returns True if the file has been created with a header
+        """
+        return os.path.exists(self.filename) and (os.path.getsize(self.filename) > 0)
+
+    def create(self, value):
+        """ Creates the file, or empties it, with a header holding value
+        """
+        with self._lock:
+            with open(self.filename, 'wb') as f:
+                f.write(HEADER.pack(self.magic, self.version, value))
+
+    def read_header(self):
+        """ Returns the value in the header. Raises ValueError if the file
+        isn't of this kind and version
+        """
+        with open(self.filename, 'rb') as f:
+            magic, version, value = HEADER.unpack(f.read(HEADER.size))
+        if (magic != self.magic) or (version != self.version):
+            raise ValueError("{f} is not a version {v} {d}".format(
+                f = self.filename, v = self.version, d = self.description))
+        return value
+
+    def append(self, records):
+        """ Appends records, a structured array, to the file. Safe to call
+        from several threads.
+        """
+        with self._lock:
+            with open(self.filename, 'ab') as f:
+                f.write(records.tobytes())
+
+    def load(self, dtype):
+        """ Returns the records as a read only, memory mapped structured array
+        of dtype. A partly written last record is ignored.
+        """
+        num_records = (os.path.getsize(self.filename) - HEADER.size) // dtype.itemsize
+        if num_records == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.filename, dtype=dtype, mode='r', offset=HEADER.size, shape=(num_records,))
@@ -1,15 +1,18 @@
 #!/usr/bin/env python
 
 import corr
-import iadc
-import calibrator
-from adc_data_wrapper import AdcDataWrapper
+import concurrent_calibration
+import calibration_cache
+import history_log
+import drift_monitor
+import metrics
 import logging
 from colorlog import ColoredFormatter
 import time
 from directionFinder_backend.correlator import Correlator
 
-ZDOK_N = 1
+ZDOKS = (0, 1)  # these get calibrated concurrently
+MONITOR_INTERVAL = None  # seconds between drift trims once calibrated, or None to exit
 
 
 if __name__ == '__main__':
@@ -21,17 +24,48 @@ if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
 
     correlator = Correlator()
-    fpga = correlator.fpga  # steal its fpga...
     logger.info("FPGA running at: {f} MHz".format(f = correlator.fpga.est_brd_clk()))
-    adr = AdcDataWrapper(correlator, ZDOK_N, logger = logger.getChild('adr'))
-    adr.resample()
-    iadc = iadc.IAdc(fpga, zdok_n = ZDOK_N, mode = 'indep', logger=logger.getChild('iadc'))
-    iadc.registers.get_from_file('registers_{zdok_n}.json'.format(zdok_n = ZDOK_N))
-    iadc.write_all_registers()
-    iadc.set_cal_mode('no_cal')
+    correlator.fetch_time_domain_snapshot(force=True)
+    calibrators = concurrent_calibration.build_calibrators(
+        correlator, ZDOKS, mode = 'indep', settle_mode = 'adaptive',
+        settle_filename = 'settle_times_{zdok_n}.json',
+        history = history_log.HistoryLog('calibration_history.bin', logger = logger.getChild('history')),
+        logger = logger)
+    for cal in calibrators:
+        cal.iadc.registers.get_from_file('registers_{zdok_n}.json'.format(zdok_n = cal.zdok_n))
+        cal.get_offset_slopes_from_file('offset_slopes_{zdok_n}.json'.format(zdok_n = cal.zdok_n))
+        cal.iadc.write_all_registers()
+        cal.iadc.set_cal_mode('no_cal')
     time.sleep(0.5)
-    cal = calibrator.Calibrator(iadc, adr, interleaved=False, logger=logger.getChild('calibrator'))
-    cal.run_offset_cal()
-    #cal.run_phase_difference_cal()
-    #cal.run_analogue_gain_cal()
-    iadc.registers.save_to_file('registers_{zdok_n}.json'.format(zdok_n = ZDOK_N))
+    cache = calibration_cache.CalibrationCache('calibration_cache.json', logger = logger.getChild('cache'))
+    board = correlator.fpga.host
+    clock = correlator.fpga.est_brd_clk()
+    concurrent_calibration.run_concurrently(calibrators, lambda cal: calibration_cache.warm_start(
+        cal, cache, board, clock, lambda c: c.run_offset_cal_model(), residuals = ('offset_I', 'offset_Q')))
+    #concurrent_calibration.run_concurrently(calibrators, lambda cal: cal.run_phase_difference_cal())
+    #concurrent_calibration.run_concurrently(calibrators, lambda cal: cal.run_analogue_gain_cal())
+    # or all three at once:
+    #concurrent_calibration.run_concurrently(calibrators, lambda cal: cal.run_joint_cal())
+    for cal in calibrators:
+        cal.iadc.registers.save_to_file('registers_{zdok_n}.json'.format(zdok_n = cal.zdok_n))
+        cal.save_offset_slopes('offset_slopes_{zdok_n}.json'.format(zdok_n = cal.zdok_n))
+        for register, (count, total) in cal.settle.latency_summary().items():
+            logger.info("ZDOK {z}: {n} writes to {r} took {t:.2f} s to settle".format(
+                z = cal.zdok_n, n = count, r = register, t = total))
+    with open('metrics.json', 'w') as f:
+        f.write(metrics.REGISTRY.to_json())
+    with open('metrics.prom', 'w') as f:
+        f.write(metrics.REGISTRY.to_prometheus())
+    if MONITOR_INTERVAL is not None:
+        # only the offsets are calibrated above so only they are trimmed
+        monitors = [drift_monitor.DriftMonitor(cal, interval = MONITOR_INTERVAL, registers = ('offset',),
+                                               logger = logger.getChild('monitor{n}'.format(n = cal.zdok_n)))
+                    for cal in calibrators]
+        for monitor in monitors:
+            monitor.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            for monitor in monitors:
+                monitor.stop()
@@ -0,0 +1,138 @@
+"""
+Decides how long to wait after a register write before the ADC data
+reflects the change.
+"""
+
+import json
+import logging
+import os
+import time
+import numpy as np
+import metrics
+
+class SettleDetector(object):
+    def __init__(self, adc_data_wrapper, mode='fixed', filename=None, fixed_delay=0.1,
+                 noise_multiple=3.0, max_wait=1.0, logger=logging.getLogger(__name__)):
+        """
+        adc_data_wrapper -- AdcDataWrapper which gets resampled once settled
+        mode --
+            fixed: always sleep for fixed_delay and then capture.
+            adaptive: capture straight after the write and keep capturing
+                until the statistic stops changing. The time this took is
+                learnt per register and is simply slept for next time.
+        filename -- JSON file in which learnt settle times are persisted.
+            Default: None, which means they are not persisted.
+        fixed_delay -- seconds to sleep in fixed mode
+        noise_multiple -- the statistic is stable once successive captures
+            differ by less than this many standard errors
+        max_wait -- seconds after which adaptive mode gives up waiting
+        """
+        assert(mode in ('fixed', 'adaptive'))
+        self.logger = logger
+        self.adw = adc_data_wrapper
+        self.mode = mode
+        self.filename = filename
+        self.fixed_delay = fixed_delay
+        self.noise_multiple = noise_multiple
+        self.max_wait = max_wait
+        self.settle_times = {}  # register name -> learnt settle time in seconds
+        self.latencies = []  # (register name, seconds from write to settled capture) for every step
+        self.time_slept = 0.0  # total seconds spent sleeping
+        self._sleep_timer = metrics.REGISTRY.timer(
+            'settle_sleep_seconds', "Time slept waiting for register writes to apply",
+            zdok=adc_data_wrapper.zdok_n)
+        self._settle_timers = {}  # register name -> Timer
+        if (filename is not None) and os.path.exists(filename):
+            with open(filename) as f:
+                self.settle_times = json.loads(f.read())
+
+    def wait(self, register, statistic, error):
+        """ Call after register has been written. Returns once the
+        AdcDataWrapper has been resampled with data reflecting the change.
+
+        register -- name of the register which was written. eg: 'offset' or 'fisda'
+        statistic -- callable returning the statistic being calibrated on for
+            the current capture. May return a sequence.
+        error -- callable returning the standard error of statistic
+        """
+        start = time.time()
+        if (self.mode == 'fixed') or ((register not in self.settle_times) and (self.adw.generation == 0)):
+            # with no capture from before the write there is nothing to detect a change against
+            self._sleep(self.fixed_delay)
+            self.adw.resample()
+        elif register in self.settle_times:
+            self._sleep(self.settle_times[register])
+            self.adw.resample()
+        else:
+            # the wrapper still holds the capture from before the write
+            self._detect(register, start, np.asarray(statistic()), np.asarray(error()), statistic, error)
+        latency = time.time() - start
+        self.latencies.append((register, latency))
+        if register not in self._settle_timers:
+            self._settle_timers[register] = metrics.REGISTRY.timer(
+                'settle_seconds', "Time from a register write until a capture reflects it",
+                zdok=self.adw.zdok_n, register=register)
+        self._settle_timers[register].observe(latency)
+        self.logger.debug("Settled after write to {r} in {t:.3f} s".format(r = register, t = latency))
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+        self.time_slept += seconds
+        self._sleep_timer.observe(seconds)
+
+    def _detect(self, register, start, before, before_error, statistic, error):
+        """ Captures until the statistic has moved away from its value before
+        the write and two successive captures agree. The change had settled
+        by the time the first of those two captures had been taken. This
+        includes any time spent waiting for other ADCs sharing the capture,
+        as the register settles meanwhile.
+        The standard error of a single capture is itself noisy, so the
+        tolerance uses the mean variance of all of the captures seen.
+        If no change is seen within fixed_delay the write was too small to
+        learn from, so this falls back to waiting for fixed_delay.
+        """
+        changed = False
+        variances = [np.square(before_error)]
+        last_value = None
+        taken = None  # seconds from start until the current capture had been taken
+        while True:
+            previous_taken = taken
+            capture_start = time.time()
+            self.adw.resample()
+            taken = time.time() - start
+            value = np.asarray(statistic())
+            variances.append(np.square(np.asarray(error())))
+            tolerance = self.noise_multiple * np.sqrt(2 * np.mean(variances, axis=0))
+            if not changed:
+                changed = np.any(np.abs(value - before) > tolerance)
+            elif (last_value is not None) and np.all(np.abs(value - last_value) <= tolerance):
+                self.learn(register, previous_taken)
+                return
+            if (not changed) and ((time.time() - start) >= self.fixed_delay):
+                if (capture_start - start) < self.fixed_delay:
+                    self.adw.resample()
+                return
+            if (time.time() - start) > self.max_wait:
+                self.logger.warn("Gave up waiting for {r} to settle after {t:.3f} s".format(
+                    r = register, t = time.time() - start))
+                return
+            last_value = value
+
+    def learn(self, register, settle_time):
+        """ Records a settle time for register and persists it
+        """
+        self.settle_times[register] = settle_time
+        self.logger.info("Learnt settle time of {t:.3f} s for {r}".format(t = settle_time, r = register))
+        if self.filename is not None:
+            with open(self.filename, 'w') as f:
+                f.write(json.dumps(self.settle_times, sort_keys=True, indent=4))
+
+    def latency_summary(self):
+        """ Returns a dict mapping register name to a tuple of
+        (number of steps, total seconds spent settling)
+        """
+        summary = {}
+        for register, latency in self.latencies:
+            count, total = summary.get(register, (0, 0.0))
+            summary[register] = (count + 1, total + latency)
+        return summary
@@ -0,0 +1,159 @@
+"""
+A software model of the iADC boards and snapshot blocks which stands in for
+the FpgaClient and Correlator so that the calibration routines can be run
+and profiled without a ROACH.
+
+SimulatedFpga decodes the SPI register writes which corr.iadc issues via
+blindwrite to iadc_controller. SimulatedCorrelator then synthesises int8
+snapshots of a tone as seen through each ADC core given those registers
+and some randomly generated imperfections of the board.
+"""
+
+import logging
+import time
+import numpy as np
+import iadc_register_map
+from iadc_registers import IAdcRegisters
+
+ANALOGUE_SELECTION_BITS = {0b00: 'inter_Q', 0b10: 'inter_I', 0b11: 'indep'}
+CLOCK_SELECTION_BITS = {0b00: 'neg', 0b10: 'in', 0b11: 'quad'}
+
+class SimulatedAdc(object):
+    def __init__(self, random_state, settle_time=0.0,
+                 max_offset=8.0, max_gain_mismatch=0.5, max_skew=40e-12):
+        """ The analogue imperfections and register state of one iADC.
+        The imperfections are drawn uniformly from random_state.
+
+        random_state -- np.random.RandomState
+        settle_time -- seconds after a register write before it takes effect
+        max_offset -- maximum intrinsic offset of each core in LSB
+        max_gain_mismatch -- maximum intrinsic gain of each core in dB
+        max_skew -- maximum intrinsic sampling delay of the Q core in seconds
+        """
+        self.settle_time = settle_time
+        self.offsets = {'I': random_state.uniform(-max_offset, max_offset),
+                        'Q': random_state.uniform(-max_offset, max_offset)}
+        self.gains = {'I': random_state.uniform(-max_gain_mismatch, max_gain_mismatch),
+                      'Q': random_state.uniform(-max_gain_mismatch, max_gain_mismatch)}
+        self.skew = random_state.uniform(-max_skew, max_skew)
+        self.best_isa = -100  # ps. Moving away from this adds noise
+        self.registers = IAdcRegisters()
+        self._pending = []  # (time at which it applies, address, word)
+
+    def spi_write(self, address, word):
+        self._pending.append((time.time() + self.settle_time, address, word))
+
+    def apply_pending(self):
+        """ Applies the register writes which have had time to settle
+        """
+        now = time.time()
+        for write in [w for w in self._pending if w[0] <= now]:
+            self._pending.remove(write)
+            _, address, word = write
+            if address not in iadc_register_map.FIELDS:
+                continue
+            for name, value in iadc_register_map.decode(address, word).items():
+                self.registers[name] = value
+
+    def analogue_selection(self):
+        return ANALOGUE_SELECTION_BITS[(self.registers['control'].value >> 4) & 0b11]
+
+    def clock_selection(self):
+        return CLOCK_SELECTION_BITS.get((self.registers['control'].value >> 6) & 0b11, 'in')
+
+    def sample(self, inputs, times, fs, noise, random_state):
+        """ Returns the (I, Q) core outputs as int8 arrays
+
+        inputs -- dict mapping 'I' and 'Q' to callables giving the input
+            voltage in LSB at an array of times
+        times -- nominal sample times in seconds
+        """
+        self.apply_pending()
+        selection = self.analogue_selection()
+        sources = {'indep': ('I', 'Q'), 'inter_I': ('I', 'I'), 'inter_Q': ('Q', 'Q')}[selection]
+        clock_delay = {'in': 0.0, 'neg': 0.5 / fs, 'quad': 0.25 / fs}[self.clock_selection()]
+        delays = {'I': 0.0, 'Q': clock_delay + self.skew + (self.registers['fisda_q'] * 1e-12)}
+        gains = {
+            'I': self.gains['I'] + self.registers['analogue_gain_vi'],
+            'Q': self.gains['Q'] + self.registers['analogue_gain_vq'] + self.registers['gain_compensation_vq'],
+        }
+        offsets = {'I': self.offsets['I'] + self.registers['offset_vi'],
+                   'Q': self.offsets['Q'] + self.registers['offset_vq']}
+        isa_errors = {'I': abs(self.registers['isa_i'] - self.best_isa) / 50.0,
+                      'Q': abs(self.registers['isa_q'] - self.best_isa) / 50.0}
+        outputs = []
+        for core, source in zip(('I', 'Q'), sources):
+            signal = inputs[source](times + delays[core]) * (10 ** (gains[core] / 20.0))
+            signal += offsets[core]
+            signal += random_state.normal(0, noise * (1 + isa_errors[core]), len(times))
+            outputs.append(np.clip(np.round(signal), -128, 127).astype(np.int8))
+        return outputs
+
+class SimulatedFpga(object):
+    def __init__(self, adcs, fs=800e6):
+        """ Stands in for corr.katcp_wrapper.FpgaClient.
+
+        adcs -- list of SimulatedAdc, indexed by ZDOK
+        """
+        self.adcs = adcs
+        self.fs = fs
+        self.spi_writes = 0
+
+    def blindwrite(self, device_name, data, offset=0):
+        if device_name != 'iadc_controller' or offset < 0x4:
+            return  # mode and reset pulses have no effect on the model
+        data = bytearray(data)
+        zdok_n = (offset - 0x4) // 0x4
+        word = (data[0] << 8) | data[1]
+        self.adcs[zdok_n].spi_write(data[2], word)
+        self.spi_writes += 1
+
+    def read(self, device_name, size, offset=0):
+        return b'\x00' * size
+
+    def est_brd_clk(self):
+        return self.fs / 4 / 1e6
+
+class SimulatedCorrelator(object):
+    def __init__(self, num_zdoks=2, fs=800e6, num_samples=2**14, tone_freq=None,
+                 tone_amplitude=50.0, noise=1.0, settle_time=0.0, capture_time=0.0, seed=0,
+                 logger=logging.getLogger(__name__)):
+        """ Stands in for directionFinder_backend.correlator.Correlator with
+        simulated ADCs. The same tone is fed to the I and Q inputs of each ADC.
+
+        num_zdoks -- number of simulated ADC boards
+        fs -- sample rate of each core in Hz
+        num_samples -- samples per channel per snapshot
+        tone_freq -- frequency of the input tone. Default: fs/8, slightly
+            detuned so that it isn't bin centred
+        tone_amplitude -- amplitude of the tone in LSB
+        noise -- standard deviation of the additive noise in LSB
+        settle_time -- seconds before a register write takes effect
+        capture_time -- seconds that each snapshot takes
+        seed -- seed for the imperfections and noise
+        """
+        self.logger = logger
+        self.fs = float(fs)
+        self.num_samples = num_samples
+        self.tone_freq = tone_freq if tone_freq is not None else (self.fs / 8) * 1.0123
+        self.tone_amplitude = tone_amplitude
+        self.noise = noise
+        self.capture_time = capture_time
+        self.random_state = np.random.RandomState(seed)
+        self.adcs = [SimulatedAdc(self.random_state, settle_time) for _ in range(num_zdoks)]
+        self.fpga = SimulatedFpga(self.adcs, fs)
+        self.snapshots = 0
+        self.time_domain_signals = None
+
+    def fetch_time_domain_snapshot(self, force=False):
+        if self.capture_time:
+            time.sleep(self.capture_time)
+        times = np.arange(self.num_samples) / self.fs
+        phase = self.random_state.uniform(0, 2 * np.pi)
+        tone = lambda t: self.tone_amplitude * np.sin((2 * np.pi * self.tone_freq * t) + phase)
+        inputs = {'I': tone, 'Q': tone}
+        signals = []
+        for adc in self.adcs:
+            signals.extend(adc.sample(inputs, times, self.fs, self.noise, self.random_state))
+        self.time_domain_signals = signals
+        self.snapshots += 1